@@ -4,6 +4,7 @@ Description: Button and Manager Class for UI with open CV
 """
 
 import cv2
+import numpy as np
 from Style import Color, Size, Font
 
 
@@ -35,6 +36,9 @@ class Button:
 
         self.background = False
 
+        # A disabled button is drawn faded (e.g. while the models are loading).
+        self.enabled = True
+
     def set_location(self, x, y):
         # Set the button's position.
         self.x = x
@@ -88,7 +92,8 @@ class Button:
             # If it is not an icon button, it fits the text size of the button and puts it in the button.
             size = cv2.getTextSize(self.text, self.button_font, self.text_size, 1)
             cv2.putText(image, self.text, (self.x + int(self.w / 2 - size[0][0] / 2), self.y + int(self.h / 2) + 10),
-                        self.button_font, self.text_size, self.text_color, 2, cv2.LINE_AA)
+                        self.button_font, self.text_size,
+                        self.text_color if self.enabled else Color.light_gray, 2, cv2.LINE_AA)
         else:
             if self.background:
                 set_icon(image, self.icon, x=int(self.x + (self.w / 2) - int(self.w * 0.0625 / 2)),
@@ -132,6 +137,15 @@ class ButtonManager:
         self.button_list = []
         self.button_flag = []
 
+        # Pre-rendered button bar: BGRA sprite of the top band of the frame and its mask.
+        # It is rendered again only when a button flag or the frame size changes.
+        self.sprite = None
+        self.sprite_mask = None
+        self.sprite_key = None
+
+        # Buttons do not react to clicks while disabled.
+        self.enabled = True
+
         self.loc = loc
         if self.loc == 0:
             self.loc_x = 0.02
@@ -141,6 +155,7 @@ class ButtonManager:
 
     def set_button_location(self, image):
         # This function calculates the position of the buttons and delivers them to each button.
+        # Buttons that do not fit in the row continue on the next row.
         for i in range(len(self.button_list)):
             if i == 0:
                 self.button_list[i].calculate_size(image)
@@ -150,14 +165,45 @@ class ButtonManager:
                     pre_x, pre_y = self.button_list[i - 1].get_location()
                     wid, hei = self.button_list[i - 1].get_size()
                     self.button_list[i].calculate_size(image)
-                    self.button_list[i].set_location(int(pre_x + wid + self.btn_interval_x), pre_y)
+                    x = int(pre_x + wid + self.btn_interval_x)
+                    if x + self.button_list[i].w > self.img_w:
+                        x, pre_y = self.start_x, pre_y + hei + self.loc_y
+                    self.button_list[i].set_location(x, pre_y)
 
     def draw(self, image):
         # This is a function to set the buttons in the button list and draw them on the screen.
+        # The buttons are drawn with one masked copy of the cached sprite.
+        key = (image.shape, tuple(self.button_flag), len(self.button_list), self.enabled)
+        if key != self.sprite_key:
+            self.render(image)
+            self.sprite_key = key
+        band = image[:self.sprite.shape[0]]
+        np.copyto(band, self.sprite[:, :, :3], where=self.sprite_mask)
+
+    def render(self, image):
+        # Draw the buttons into the sprite.
+        # They are drawn on a black and on a white canvas: the pixels that differ were not drawn and stay transparent.
         self.set_button_location(image)
         self.check_flag()
+        black = np.zeros_like(image)
+        white = np.full_like(image, 255)
+        for button in self.button_list:
+            button.draw(black)
+            button.draw(white)
+        mask = np.all(black == white, axis=2)
+
+        # The sprite covers the rows down to the lowest drawn pixel.
+        rows = np.flatnonzero(mask.any(axis=1))
+        height = rows[-1] + 1 if len(rows) else 0
+        self.sprite = cv2.cvtColor(black[:height], cv2.COLOR_BGR2BGRA)
+        self.sprite[:, :, 3] = mask[:height] * 255
+        self.sprite_mask = mask[:height, :, np.newaxis].copy()
+
+    def set_enabled(self, enabled):
+        # Enable or disable all the buttons.
+        self.enabled = enabled
         for button in self.button_list:
-            button.draw(image)
+            button.enabled = enabled
 
     def add_button(self, button):
         # It receives the button object and puts it in the button list.
@@ -179,15 +225,19 @@ class ButtonManager:
 
     def btn_on_click(self, x, y):
         # Change the status of button_flag by checking which button in the button list has an event.
+        if not self.enabled:
+            return
+        # The last button is the face icon, the others are the style buttons.
+        styles = len(self.button_list) - 1
         for i in range(len(self.button_list)):
             if self.button_list[i].on_click(x, y):
-                if i == 6:
+                if i == styles:
                     self.button_flag[i] = 1
                 else:
                     if self.button_flag[i] == 1:
-                        self.button_flag[:6] = [0 for _ in range(6)]
+                        self.button_flag[:styles] = [0 for _ in range(styles)]
                     else:
-                        self.button_flag[:6] = [0 for _ in range(6)]
+                        self.button_flag[:styles] = [0 for _ in range(styles)]
                         self.button_flag[i] = 1
                     break
 
@@ -199,27 +249,30 @@ class ButtonManager:
             else:
                 self.button_list[i].button_toggle = False
 
-    def button_setting(self):
-        # This is an example function.
-        # You can create a button using the example below.
-        btn = Button()
-        btn.set_text("Gogh")
-        btn2 = Button()
-        btn2.set_text("Kandinsky")
-        btn2.text_size = 0.4
-        btn3 = Button()
-        btn3.set_text("Monet")
-        btn4 = Button()
-        btn4.set_text("Picasso")
-        btn5 = Button()
-        btn5.set_text("Na")
-        btn6 = Button()
-        btn6.set_text("Mario")
+    def button_setting(self, style_names=("Gogh", "Kandinsky", "Monet", "Picasso", "Na", "Mario")):
+        # Create a button for every style name, followed by the face icon button.
+        btn_list = []
+        for name in style_names:
+            btn = Button()
+            btn.set_text(name)
+            if len(name) > 8:
+                # Long names get a smaller text so that they fit the button.
+                btn.text_size = 0.4
+            btn_list.append(btn)
         icon = cv2.imread('baseline_tag_faces_black_28.png')
         btn7 = Button()
         btn7.icon = icon
-        btn_list = [btn, btn2, btn3, btn4, btn5, btn6, btn7]
+        btn_list.append(btn7)
         self.add_button_list(btn_list)
+        self.set_enabled(self.enabled)
+
+    def set_styles(self, style_names):
+        # Replace the style buttons (e.g. after the style library changed). All styles are switched off,
+        # the face icon keeps its state. Call it from the thread that draws the buttons.
+        face = self.button_flag[-1] if self.button_flag else 0
+        self.button_setting(style_names)
+        self.button_flag[-1] = face
+        self.sprite_key = None
 
 
 def set_icon(image, icon, x, y, white=True, icon_size=28):
@@ -5,23 +5,51 @@ Description: Streaming Camera with zoom function, face segmentation, and style t
 
 import cv2
 import time
-import os
-import datetime
-from threading import Thread
-from queue import Queue
+from threading import Event, Thread
 import numpy as np
 
 from style_transfer import StyleTransfer
+from style_library import list_styles
 from image_segmentation import ImageSegmentation
+from compositor import Compositor
+from frame_pipeline import FrameBus, Mailbox
+from recorder import PreRollBuffer, Recorder
+from storage import StorageManager
+from snapshot import SnapshotWriter
+from metrics import LiveMetrics, MetricsServer, draw_hud
+from resources import ResourceConfig, model_executor, uses_tensorflow
+from quality import QualityController
 from Button import ButtonManager
 
 
 class Camera:
     # Camera class for streaming
-    def __init__(self, mirror=False, style=False):
+    def __init__(self, mirror=False, style=False, style_scale=1.0, segmentation_interval=5,
+                 style_threads=None, segmentation_threads=None, feather=0, pre_roll_seconds=3,
+                 pre_roll_max_bytes=64 * 1024 * 1024, picture_format='.png', picture_compression=3,
+                 metrics_port=None, style_backend='savedmodel', segmentation_backend='keras', resources=None,
+                 inference=None, target_fps=None):
         """
         mirror: Support camera mirror mode
         style: Style transfer application
+        style_scale: Inference scale of the style model relative to the capture size
+        segmentation_interval: The segmentation model runs at most every this many frames,
+                               masks in between are propagated with optical flow
+        style_threads, segmentation_threads: Thread budget of each model, the two models run in parallel
+                                             (None: the budget of resources)
+        feather: Size of the blur that softens the edge between the styled and the original area (0: hard edge)
+        pre_roll_seconds: Seconds before the record key was pressed that are included in the recording (0: none)
+        pre_roll_max_bytes: Memory cap of the pre-roll. It holds pre_roll_seconds at the measured frame rate,
+                            or fewer frames when they do not fit.
+        picture_format, picture_compression: Format ('.png', '.jpg' or '.webp') and compression level of pictures
+        metrics_port: Port of the localhost endpoint that serves the metrics to Prometheus (None: no endpoint)
+        style_backend, segmentation_backend: Inference backend of each model (see backends.py)
+        resources: ResourceConfig with the threads and CPUs of the models and open-cv
+                   (None: resources.json when it exists, else the default split of the cores)
+        inference: Client of a shared inference service (InferenceClient or LocalInferenceClient of
+                   inference_server.py). The camera then loads no models and sends its frames to the service.
+        target_fps: Frame rate that the quality controller holds by changing style_scale, segmentation_interval
+                    and feather at runtime (None: the fixed settings above). Needs local models.
         """
         self.data = None
         self.data_ready = False
@@ -38,9 +66,38 @@ class Camera:
         self.center_y = self.HEIGHT / 2
         self.touched_zoom = False
 
-        # Queue for image capture and video recording.
-        self.image_queue = Queue()
-        self.video_queue = Queue()
+        # Latest-frame hand-off from capture to inference and from inference to display.
+        self.captured = Mailbox()
+        self.processed = Mailbox()
+
+        # Rolling storage of the recorded videos and the saved pictures.
+        self.video_storage = StorageManager('videos', ('.avi',), max_files=100)
+        self.image_storage = StorageManager('images', ('.png', '.jpg', '.webp'))
+        # It encodes and writes pictures on background threads.
+        self.snapshot_writer = SnapshotWriter('images', ext=picture_format, compression=picture_compression)
+        # It records the processed frames on its own thread.
+        # The pre-roll keeps the last seconds, so a recording includes the moment before 'r' was pressed.
+        self.recorder = Recorder('videos', storage=self.video_storage,
+                                 pre_roll=PreRollBuffer(seconds=pre_roll_seconds, max_bytes=pre_roll_max_bytes)
+                                 if pre_roll_seconds else None)
+        # Rate of processed frames, used to stamp the recorded frames.
+        self.fps = 20.0
+        self.last_timestamp = None
+
+        # Per-stage latency, counters and gauges of the stream, shown on the HUD ('h') and served to Prometheus.
+        self.metrics = LiveMetrics()
+        self.show_hud = False
+        self.metrics_server = MetricsServer(self.metrics, metrics_port).start() if metrics_port else None
+
+        # Every processed frame is published once to these sinks, which share it without copies.
+        self.frame_bus = FrameBus()
+        self.frame_bus.subscribe(self.keep_frame)
+        self.frame_bus.subscribe(self.display_frame)
+        self.frame_bus.subscribe(self.recorder.write)
+        self.frame_bus.subscribe(self.measure_fps)
+        self.frame_bus.subscribe(self.measure_frame)
+        # Private copy of the displayed frame, on which the buttons are drawn.
+        self.overlay = None
 
         # Button manager object for creating UI buttons.
         self.btn_manager = ButtonManager(self.WIDTH, self.HEIGHT)
@@ -53,10 +110,50 @@ class Camera:
 
         # Whether to apply the style transfer to the face only.
         self.face_transfer = False
+        # Style names of the library after it changed, applied to the buttons by show().
+        self.pending_styles = None
+        # Index of the selected style.
+        self.current_style = 1
+        self.inference = inference
+        # Thread budgets and CPU sets, applied when the models are loaded.
+        self.resources = resources if resources is not None else ResourceConfig.load_or_default()
+        if style_threads is not None:
+            self.resources.style_threads = style_threads
+        if segmentation_threads is not None:
+            self.resources.segmentation_threads = segmentation_threads
+        # The two models run at the same time, each on its own thread pinned to its CPUs
+        # (with a TensorFlow backend the whole process is pinned instead, see ResourceConfig.model_cpus).
+        self.uses_tensorflow = uses_tensorflow(style_backend, segmentation_backend)
+        style_cpus, segmentation_cpus = self.resources.model_cpus(self.uses_tensorflow)
+        self.style_executor = model_executor(style_cpus, 'style')
+        self.segmentation_executor = model_executor(segmentation_cpus, 'segment')
+        # The models are loaded on a background thread (see load_models), so the raw preview starts at once.
         # An object that performs style transfers.
-        self.style_transfer = StyleTransfer(self.WIDTH, self.HEIGHT)
+        self.style_transfer = None
         # It is an object that recognizes the face and segments it.
-        self.image_segmentation = ImageSegmentation(self.WIDTH, self.HEIGHT)
+        self.image_segmentation = None
+        # It combines the styled frame and the original frame with the mask in transform().
+        # buffers=0: every result is a new array, because published frames are kept by reference.
+        self.compositor = Compositor(self.WIDTH, self.HEIGHT, feather=feather, buffers=0)
+        self.model_settings = {'style_scale': style_scale, 'segmentation_interval': segmentation_interval,
+                               'style_backend': style_backend, 'segmentation_backend': segmentation_backend}
+        # Set when both models are loaded and warmed up.
+        self.models_ready = Event()
+        # It trades quality for speed to hold target_fps.
+        self.quality = QualityController(target_fps) if target_fps and inference is None else None
+
+        self.metrics.set_gauge('fps', lambda: self.fps)
+        self.metrics.set_gauge('models_ready', lambda: int(self.models_ready.is_set()))
+        self.metrics.set_gauge('capture_dropped_frames', lambda: self.captured.dropped)
+        self.metrics.set_gauge('display_dropped_frames', lambda: self.processed.dropped)
+        self.metrics.set_gauge('recorder_dropped_frames', lambda: self.recorder.dropped)
+        self.metrics.set_gauge('recorder_queue_depth', lambda: self.recorder.queue.qsize())
+        if self.quality is not None:
+            self.metrics.set_gauge('quality_level', lambda: self.quality.level)
+            self.metrics.set_gauge('quality_fps', lambda: self.quality.fps())
+            self.metrics.set_gauge('style_scale', lambda: self.quality.settings()['style_scale'])
+            self.metrics.set_gauge('segmentation_interval', lambda: self.quality.settings()['segmentation_interval'])
+            self.metrics.set_gauge('feather', lambda: self.quality.settings()['feather'])
 
         self.__setup()
 
@@ -64,10 +161,70 @@ class Camera:
         # Prepare the camera settings, button manager, and style transfer objects.
         self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, self.WIDTH)
         self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, self.HEIGHT)
-
-        self.btn_manager.button_setting()
-        self.style_transfer.load()
-        time.sleep(2)
+        # Do not let frames queue up in the driver.
+        self.cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        self.btn_manager.button_setting(list_styles())
+        # Style buttons become active when the models are ready.
+        self.btn_manager.set_enabled(False)
+        self.wait_for_camera()
+        Thread(target=self.load_models, daemon=True).start()
+
+    def wait_for_camera(self, timeout=5.0):
+        # Wait until the camera delivers a frame, instead of sleeping for a fixed time.
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            ret, _ = self.cam.read()
+            if ret:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def load_models(self):
+        # Model loading thread Function
+        # TensorFlow is imported, the models are loaded and warmed up while the raw preview is running.
+        if self.inference is not None:
+            # The service has the models: only the style names are needed.
+            names = self.inference.style_names()
+            if names != [button.get_text() for button in self.btn_manager.button_list[:-1]]:
+                self.pending_styles = names
+            self.models_ready.set()
+            self.btn_manager.set_enabled(True)
+            return
+        settings = self.model_settings
+        resources = self.resources
+        resources.apply(self.uses_tensorflow)
+        # Each model is loaded on the thread it runs on, so the thread pools of its runtime get the same CPUs.
+        style_transfer = self.style_executor.submit(self.load_style_transfer, settings, resources).result()
+        image_segmentation = self.segmentation_executor.submit(
+            ImageSegmentation, self.WIDTH, self.HEIGHT, keyframe_interval=settings['segmentation_interval'],
+            backend=settings['segmentation_backend'], num_threads=resources.segmentation_threads).result()
+
+        self.style_transfer = style_transfer
+        self.image_segmentation = image_segmentation
+        if self.quality is not None:
+            self.apply_quality(self.quality.settings())
+        self.metrics.set_gauge('segmentation_keyframes', lambda: image_segmentation.keyframes)
+        self.metrics.set_gauge('segmentation_propagated', lambda: image_segmentation.propagated)
+        # Styles added to or removed from the style folder while the camera runs change the buttons.
+        library = style_transfer.library
+        library.subscribe(self.styles_changed)
+        if library.names() != [button.get_text() for button in self.btn_manager.button_list[:-1]]:
+            self.styles_changed(library)
+        library.start_watching()
+        self.models_ready.set()
+        self.btn_manager.set_enabled(True)
+
+    def styles_changed(self, library):
+        # Called by the style library watcher.
+        self.pending_styles = library.names()
+
+    def load_style_transfer(self, settings, resources):
+        style_transfer = StyleTransfer(self.WIDTH, self.HEIGHT, scale=settings['style_scale'],
+                                       num_threads=resources.style_threads)
+        style_transfer.load(backend=settings['style_backend'])
+        style_transfer.warm_up()
+        return style_transfer
 
     def get_location(self, x, y):
         # Specifies the center of the current screen.
@@ -76,39 +233,94 @@ class Camera:
         self.touched_zoom = True
 
     def stream(self):
-        # Streaming thread Function
-        def streaming():
-            self.ret = True
-            while self.ret:
+        # Start the streaming threads.
+        # Capture keeps only the newest camera frame, inference always takes the newest one and drops stale frames,
+        # and show() waits for processed frames, so slow inference does not pile up latency.
+        self.ret = True
+        Thread(target=self.capturing, daemon=True).start()
+        Thread(target=self.streaming, daemon=True).start()
+
+    def capturing(self):
+        # Capture thread Function
+        while self.ret:
+            with self.metrics.time('capture'):
                 self.ret, np_image = self.cam.read()
-                self.data_ready = False
-                if np_image is None:
-                    continue
-                if self.mirror:
-                    # Mirror mode function
-                    np_image = cv2.flip(np_image, 1)
-                if self.touched_zoom:
-                    # When using the double-click zoom function,
-                    np_image = self.__zoom(np_image, (self.center_x, self.center_y))
-                else:
-                    # When not zoomed,
-                    if not self.scale == 1:
-                        np_image = self.__zoom(np_image)
-
-                if self.style:
-                    # Convert image to style transfer
-                    image_result = self.transform(np_image)
-
-                    np_image = image_result
-
-                self.data = np_image
-                self.data_ready = True
-                k = cv2.waitKey(1)
-                if k == ord('q'):
-                    self.release()
-                    break
-
-        Thread(target=streaming).start()
+            if np_image is None:
+                continue
+            self.metrics.inc('frames_captured')
+            self.captured.put((np_image, time.time()))
+        self.captured.close()
+
+    def streaming(self):
+        # Inference thread Function
+        while self.ret:
+            captured = self.captured.get(timeout=0.1)
+            if captured is None:
+                continue
+            np_image, timestamp = captured
+            frame_start = time.perf_counter()
+            # Time the frame waited for the inference thread.
+            self.metrics.observe('capture_wait', time.time() - timestamp)
+            self.data_ready = False
+            if self.mirror:
+                # Mirror mode function
+                np_image = cv2.flip(np_image, 1)
+            if self.touched_zoom:
+                # When using the double-click zoom function,
+                np_image = self.__zoom(np_image, (self.center_x, self.center_y))
+            else:
+                # When not zoomed,
+                if not self.scale == 1:
+                    np_image = self.__zoom(np_image)
+
+            if self.style and self.models_ready.is_set():
+                # Convert image to style transfer
+                image_result = self.transform(np_image)
+
+                np_image = image_result
+                if self.quality is not None:
+                    # The processing time of the frame, not the camera's frame rate, shows the headroom.
+                    settings = self.quality.update(time.perf_counter() - frame_start)
+                    if settings is not None:
+                        self.apply_quality(settings)
+
+            self.frame_bus.publish(np_image, timestamp)
+        self.processed.close()
+
+    def apply_quality(self, settings):
+        # Set the quality levers. Runs on the inference thread, between frames.
+        self.style_transfer.scale = settings['style_scale']
+        if self.image_segmentation.keyframe_interval != settings['segmentation_interval']:
+            self.image_segmentation.keyframe_interval = settings['segmentation_interval']
+            # The keyframe may be from before the interval was 1, so the next frame runs the model.
+            self.image_segmentation.reset()
+        self.compositor.set_feather(settings['feather'])
+        self.metrics.inc('quality_changes')
+
+    def keep_frame(self, frame, timestamp):
+        # Frame bus sink: the newest processed frame, used for pictures.
+        self.data = frame
+        self.data_ready = True
+
+    def display_frame(self, frame, timestamp):
+        # Frame bus sink: hands the frame to show().
+        self.processed.put(frame)
+
+    def measure_frame(self, frame, timestamp):
+        # Frame bus sink: counts processed frames and measures the latency from capture to publication.
+        self.metrics.inc('frames_processed')
+        self.metrics.observe('capture_to_publish', time.time() - timestamp)
+
+    def measure_fps(self, frame, timestamp):
+        # Frame bus sink: measured rate of processed frames (exponential moving average).
+        if self.last_timestamp is not None and timestamp > self.last_timestamp:
+            self.fps = 0.9 * self.fps + 0.1 / (timestamp - self.last_timestamp)
+        self.last_timestamp = timestamp
+
+    def dropped_frames(self):
+        # Number of frames dropped by each stage: camera frames that inference skipped,
+        # and processed frames that were replaced before they were displayed.
+        return {'capture': self.captured.dropped, 'display': self.processed.dropped}
 
     def __zoom(self, img, center=None):
         # This function calculates various values ​​according to the scale of the current screen
@@ -160,6 +372,7 @@ class Camera:
         self.center_y = self.HEIGHT / 2
         self.touched_zoom = False
         self.scale = 1
+        self.reset_segmentation()
 
     def zoom_out(self):
         # Zoom-out by increasing the scale value
@@ -169,11 +382,18 @@ class Camera:
             self.center_x = self.WIDTH
             self.center_y = self.HEIGHT
             self.touched_zoom = False
+        self.reset_segmentation()
 
     def zoom_in(self):
         # Zoom-in function by reducing scale value
         if self.scale > 0.2:
             self.scale -= 0.1
+        self.reset_segmentation()
+
+    def reset_segmentation(self):
+        # The view jumps, so the propagated mask no longer fits.
+        if self.image_segmentation is not None:
+            self.image_segmentation.reset()
 
     def zoom(self, num):
         # Zoom in & out according to index
@@ -186,70 +406,46 @@ class Camera:
 
     def transform(self, img):
         # Functions that perform style transfers
-        copy_img = img.copy()
-        copy_img2 = img.copy()
-        # 1. Get a converted image with style transfer
-        style_img = self.style_transfer.predict(copy_img)
-        # 2. Getting a mask with face segmentation
-        seg_mask = self.image_segmentation.predict(copy_img2)
-        mask = cv2.cvtColor(seg_mask, cv2.COLOR_GRAY2RGB)
+        # 1. Get a converted image with style transfer, and
+        # 2. Getting a mask with face segmentation, at the same time.
+        # Neither model writes to img, so both can read it without a copy.
+        if self.inference is not None:
+            # The service runs both models and combines the result, batched with the frames of other cameras.
+            with self.metrics.time('inference'):
+                return self.inference.process(img, self.current_style, self.face_transfer)
+        style_future = self.style_executor.submit(self.timed, 'style', self.style_transfer.predict, img)
+        seg_future = self.segmentation_executor.submit(self.timed, 'segment', self.image_segmentation.predict, img)
+        style_img = style_future.result()
+        seg_mask = seg_future.result()
 
         # 3. Combine face only with image converted to style transfer
-        if self.face_transfer:
-            image_result = np.where(mask, style_img, img)
-        else:
-            image_result = np.where(mask, img, style_img)
-        return image_result
+        with self.metrics.time('composite'):
+            return self.compositor.composite(img, style_img, seg_mask, person=self.face_transfer)
+
+    def timed(self, stage, function, *args):
+        # Call a function and record its latency as the stage.
+        with self.metrics.time(stage):
+            return function(*args)
 
     def event(self, i):
         # Function to change style according to button event
         self.style = True
-        self.style_transfer.change_style(i)
+        self.current_style = i
+        if self.style_transfer is not None:
+            self.style_transfer.change_style(i)
 
     def save_picture(self):
         # Save Image Function
-        ret, img = self.cam.read()
-        if ret:
-            now = datetime.datetime.now()
-            date = now.strftime('%Y%m%d')
-            hour = now.strftime('%H%M%S')
-            user_id = '00001'
-            filename = './images/mevia_{}_{}_{}.png'.format(date, hour, user_id)
-            cv2.imwrite(filename, img)
-            self.image_queue.put_nowait(filename)
-
-    def record_video(self):
-        # Recording Function
-        fc = 20.0
-        record_start_time = time.time()
-        now = datetime.datetime.now()
-        date = now.strftime('%Y%m%d')
-        t = now.strftime('%H')
-        num = 1
-        filename = 'videos/mevia_{}_{}_{}.avi'.format(date, t, num)
-        while os.path.exists(filename):
-            num += 1
-            filename = 'videos/mevia_{}_{}_{}.avi'.format(date, t, num)
-        codec = cv2.VideoWriter_fourcc('D', 'I', 'V', 'X')
-        out = cv2.VideoWriter(filename, codec, fc, (int(self.cam.get(3)), int(self.cam.get(4))))
-        while self.recording:
-            if time.time() - record_start_time >= 600:
-                self.record_video()
-                break
-            ret, frame = self.cam.read()
-            if ret:
-                if len(os.listdir('./videos')) >= 100:
-                    name = self.video_queue.get()
-                    if os.path.exists(name):
-                        os.remove(name)
-                if self.data is not None:
-                    out.write(self.data)
-                else:
-                    out.write(frame)
-                self.video_queue.put_nowait(filename)
-            k = cv2.waitKey(1)
-            if k == ord('q'):
-                break
+        # The processed frame is saved by the snapshot writer, so the preview does not wait for the encoding.
+        # Published frames are read-only, so the writer can use the frame without a copy.
+        frame = self.data
+        if frame is not None:
+            self.snapshot_writer.save(frame, callback=self.picture_saved)
+
+    def picture_saved(self, filename, ok):
+        # Called by the snapshot writer when a picture has been written.
+        if ok:
+            self.image_storage.add(filename)
 
     def show(self):
         # Function to show streaming screen
@@ -261,12 +457,27 @@ class Camera:
         p: Save Picture
         v: Return initial State
         r: Video recording
+        h: Metrics HUD
         """
         while True:
-            frame = self.data
+            frame = self.processed.get(timeout=0.01)
             if frame is not None:
-                self.btn_manager.draw(frame)
-                cv2.imshow('Mevia', frame)
+                display_start = time.perf_counter()
+                # The buttons are drawn on a private copy, so they never reach recordings or pictures.
+                if self.overlay is None or self.overlay.shape != frame.shape:
+                    self.overlay = frame.copy()
+                else:
+                    np.copyto(self.overlay, frame)
+                if self.pending_styles is not None:
+                    # The style buttons change on this thread, which also handles their clicks.
+                    names, self.pending_styles = self.pending_styles, None
+                    self.btn_manager.set_styles(names)
+                    self.style = False
+                self.btn_manager.draw(self.overlay)
+                if self.show_hud:
+                    draw_hud(self.overlay, self.metrics.hud_lines())
+                cv2.imshow('Mevia', self.overlay)
+                self.metrics.observe('display', time.perf_counter() - display_start)
                 cv2.setMouseCallback('Mevia', self.mouse_callback)
             key = cv2.waitKey(1)
             if key == ord('q'):
@@ -291,15 +502,29 @@ class Camera:
                 # v : original state
                 self.touch_init()
 
+            elif key == ord('h'):
+                # h : show or hide the metrics HUD
+                self.show_hud = not self.show_hud
+
             elif key == ord('r'):
                 # r : recording
                 self.recording = not self.recording
                 if self.recording:
-                    t = Thread(target=cam.record_video)
-                    t.start()
+                    self.recorder.start(self.fps)
+                else:
+                    self.recorder.stop()
 
     def release(self):
+        self.ret = False
+        self.recorder.stop()
+        self.snapshot_writer.shutdown()
+        if self.style_transfer is not None:
+            self.style_transfer.library.stop_watching()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
         self.cam.release()
+        self.style_executor.shutdown(wait=False)
+        self.segmentation_executor.shutdown(wait=False)
         cv2.destroyAllWindows()
 
     def mouse_callback(self, event, x, y, flag, param):
@@ -1,70 +1,367 @@
-import tensorflow as tf
-import numpy as np
-import cv2
+"""
+Description: Apply style transfer to the people in the videos of the samples folder and save them to results
+"""
+
+import argparse
+import multiprocessing
 import os
-import sys
+import shutil
+import tempfile
+import time
+from queue import Queue
+from threading import Thread
+
+import cv2
+
 from style_transfer import StyleTransfer
 from image_segmentation import ImageSegmentation
+from compositor import Compositor
+from resources import ResourceConfig, uses_tensorflow
+from style_library import list_styles
+
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+styles = list_styles()
+
+# Sentinel that tells the next stage of the pipeline that the video has ended.
+END = None
+
+
+def open_video(file):
+    # Open a sample video and a writer for its result.
+    cap, frame_size = open_capture(file)
+    out = open_writer(result_path(file), frame_size)
+    return cap, out, frame_size
+
+
+def open_capture(file):
+    # Open a sample video and read its frame size.
+    cap = cv2.VideoCapture(os.path.join(path, "samples", file))
+
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_size = (frame_width, frame_height)
+    return cap, frame_size
+
+
+def open_writer(filepath, frame_size, codec='DIVX'):
+    fourcc = cv2.VideoWriter_fourcc(*codec)
+    return cv2.VideoWriter(filepath, fourcc, 24, frame_size)
+
+
+def result_path(file):
+    filename, extention = os.path.splitext(file)
+    return os.path.join(path, "results", filename + "_result" + extention)
+
+
+# Conversion options set from the command line.
+# style_scale: Inference scale of the style model relative to the video size.
+# feather: Size of the blur that softens the mask edge (0: hard edge).
+# style_backend, segmentation_backend: Inference backends (see backends.py).
+# style_model, segmentation_model: Model files of the backends (None: the default model of the backend).
+# resources: ResourceConfig with the thread budgets of the models and open-cv (None: runtime defaults).
+# tile_size, tile_overlap, tile_batch: Tiled style transfer for large frames (tile_size None: whole frames).
+options = {"style_scale": 1.0, "feather": 0, "tile_size": None, "tile_overlap": 32, "tile_batch": 4,
+           "style_backend": "savedmodel", "style_model": None,
+           "segmentation_backend": "keras", "segmentation_model": None,
+           "resources": None}
+
+
+def load_models(frame_size, style):
+    # Load the style transfer and segmentation models for frames of the given size.
+    frame_width, frame_height = frame_size
+    resources = options["resources"]
+    style_transfer = StyleTransfer(frame_width, frame_height, scale=options["style_scale"],
+                                   num_threads=resources.style_threads if resources else None,
+                                   tile_size=options["tile_size"], tile_overlap=options["tile_overlap"],
+                                   tile_batch=options["tile_batch"])
+    style_transfer.load(backend=options["style_backend"], model_path=options["style_model"])
+    style_transfer.change_style(style_transfer.library.index(style))
+    image_segmentation = ImageSegmentation(frame_width, frame_height, backend=options["segmentation_backend"],
+                                           model_path=options["segmentation_model"],
+                                           num_threads=resources.segmentation_threads if resources else None)
+    return style_transfer, image_segmentation
+
+
+def transfer_video(file, style):
+    # Convert a video one frame at a time while showing the result.
+    # Returns False when the user pressed q to stop converting the remaining videos.
+    cap, out, frame_size = open_video(file)
+    style_transfer, image_segmentation = load_models(frame_size, style)
+    compositor = Compositor(*frame_size, feather=options["feather"], buffers=1)
+
+    print("\nencoding " + file + " |", end='')
+    loop = True
+    while True:
+        print("=", end='')
+        retval, frame = cap.read()
+
+        if not retval:
+            break
+
+        style_image = style_transfer.predict(frame)
+        seg_mask = image_segmentation.predict(frame)
+
+        result_image = compositor.composite(frame, style_image, seg_mask, person=True)
+
+        cv2.imshow("result", result_image)
+        out.write(result_image)
+
+        key = cv2.waitKey(30)
+        if key == 32:
+            print("|")
+            break
+
+        if key == ord('q'):
+            print("|")
+            loop = False
+            break
+
+    cap.release()
+    out.release()
+    cv2.destroyAllWindows()
+    return loop
+
+
+def transfer_batch(style_transfer, image_segmentation, compositor, batch):
+    # Convert a list of frames with one call to each model.
+    # The results are buffers of the compositor, which must have at least len(batch) of them.
+    style_images = style_transfer.predict_batch(batch)
+    seg_masks = image_segmentation.predict_batch(batch)
+    return [compositor.composite(frame, style_image, seg_mask, person=True)
+            for frame, style_image, seg_mask in zip(batch, style_images, seg_masks)]
+
+
+def transfer_video_pipelined(file, style, batch_size=8, queue_depth=32):
+    # Convert a video without a preview window.
+    # A decoder thread and an encoder thread run while the models work on batches of frames,
+    # so decoding, inference and encoding overlap.
+    cap, out, frame_size = open_video(file)
+    style_transfer, image_segmentation = load_models(frame_size, style)
+    # A result buffer is reused only after the encoder is done with it:
+    # up to queue_depth results wait in the queue, one is being written and one batch is being combined.
+    compositor = Compositor(*frame_size, feather=options["feather"], buffers=queue_depth + batch_size + 1)
+
+    # Bounded queues: the decoder can get at most queue_depth frames ahead of the models,
+    # and the models at most queue_depth frames ahead of the encoder.
+    decoded = Queue(maxsize=queue_depth)
+    encoded = Queue(maxsize=queue_depth)
+
+    def decoding():
+        while True:
+            retval, frame = cap.read()
+            if not retval:
+                break
+            decoded.put(frame)
+        decoded.put(END)
+
+    def encoding():
+        while True:
+            frame = encoded.get()
+            if frame is END:
+                break
+            out.write(frame)
+
+    decoder = Thread(target=decoding, daemon=True)
+    encoder = Thread(target=encoding, daemon=True)
+    decoder.start()
+    encoder.start()
+
+    print("\nencoding " + file + " |", end='')
+    finished = False
+    while not finished:
+        batch = []
+        while len(batch) < batch_size:
+            frame = decoded.get()
+            if frame is END:
+                finished = True
+                break
+            batch.append(frame)
+        if not batch:
+            break
+
+        # Results are queued in decode order, so the encoder writes them in order.
+        for result_image in transfer_batch(style_transfer, image_segmentation, compositor, batch):
+            encoded.put(result_image)
+        print("=", end='')
+    print("|")
+
+    encoded.put(END)
+    decoder.join()
+    encoder.join()
+    cap.release()
+    out.release()
+
+
+# Lossless codec of the temporary segments of the worker mode.
+SEGMENT_CODEC = 'FFV1'
+
+# Models of a worker process, keyed by frame size, so that each worker loads them once.
+worker_models = {}
+
+
+def init_worker(style, tf_threads, worker_options):
+    # Limit the thread pools of a worker process before TensorFlow starts its runtime,
+    # so that the workers together do not use more threads than there are cores.
+    options.update(worker_options)
+    # The models of a worker run one after the other, so each may use all of its threads.
+    options["resources"] = ResourceConfig(style_threads=tf_threads, segmentation_threads=tf_threads, opencv_threads=1,
+                                          inter_op_threads=1, intra_op_threads=tf_threads)
+    options["resources"].apply(uses_tensorflow(options["style_backend"], options["segmentation_backend"]))
+    worker_models['style'] = style
+
+
+def transfer_shard(shard):
+    # Convert the frames [start, end) of a video into a temporary segment.
+    # end is None for the last shard, which reads until the end of the video.
+    file, index, start, end, segment, batch_size = shard
+    cap, frame_size = open_capture(file)
+    if frame_size not in worker_models:
+        compositor = Compositor(*frame_size, feather=options["feather"], buffers=batch_size)
+        worker_models[frame_size] = load_models(frame_size, worker_models['style']) + (compositor,)
+    style_transfer, image_segmentation, compositor = worker_models[frame_size]
 
+    # Segments are lossless, so the result is encoded only once, when they are merged.
+    out = open_writer(segment, frame_size, SEGMENT_CODEC)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    count = 0
+    position = start
+    while end is None or position < end:
+        batch = []
+        while len(batch) < batch_size and (end is None or position < end):
+            retval, frame = cap.read()
+            if not retval:
+                break
+            batch.append(frame)
+            position += 1
+        if not batch:
+            break
+        for result_image in transfer_batch(style_transfer, image_segmentation, compositor, batch):
+            out.write(result_image)
+        count += len(batch)
+    cap.release()
+    out.release()
+    return file, index, count
 
-path=os.path.dirname(__file__)
-loop=True
 
-styles=["Gogh","Kandinsky","Monet","Picasso","Na","Mario"]
-                 
-for file in os.listdir(os.path.join(path,"samples")):
+def split_shards(files, shard_frames, segment_dir, batch_size):
+    # Split every video into shards of shard_frames frames.
+    # The frame count of many containers is only an estimate, so the last shard has no end
+    # and reads until the video ends.
+    shards = []
+    for file in files:
+        cap, _ = open_capture(file)
+        frame_count = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 1)
+        cap.release()
+        starts = range(0, frame_count, shard_frames)
+        for index, start in enumerate(starts):
+            end = start + shard_frames if index < len(starts) - 1 else None
+            segment = os.path.join(segment_dir, "{}_{:05d}.avi".format(os.path.splitext(file)[0], index))
+            shards.append((file, index, start, end, segment, batch_size))
+    return shards
 
-     filename=file.split(".")[0]
-     extention=file.split(".")[1]
 
-     cap=cv2.VideoCapture(os.path.join(path,"samples",file))
+def merge_segments(file, segments):
+    # Concatenate the segments of a video in order into its result.
+    cap, frame_size = open_capture(file)
+    cap.release()
+    out = open_writer(result_path(file), frame_size)
+    for segment in segments:
+        seg = cv2.VideoCapture(segment)
+        while True:
+            retval, frame = seg.read()
+            if not retval:
+                break
+            out.write(frame)
+        seg.release()
+    out.release()
 
-     frame_width=int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-     frame_height=int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-     frame_size=(frame_width,frame_height)
 
-     fourcc=cv2.VideoWriter_fourcc(*'DIVX')
-     out=cv2.VideoWriter(os.path.join(path,"results",filename+"_result."+extention),fourcc,24,frame_size)
+def transfer_videos_sharded(files, style, workers=None, tf_threads=1, shard_frames=240, batch_size=8):
+    # Convert several videos at once with a pool of worker processes.
+    # Every video is split into frame-range shards, each worker converts shards into temporary segments,
+    # and the segments are concatenated in order into results.
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // tf_threads)
 
-     style_transfer=StyleTransfer(frame_width,frame_height)
-     style_transfer.load()
-     style_transfer.change_style(styles.index("Na"))
-     image_segmentation=ImageSegmentation(frame_width,frame_height)
+    segment_dir = tempfile.mkdtemp(prefix="segments_", dir=os.path.join(path, "results"))
+    try:
+        shards = split_shards(files, shard_frames, segment_dir, batch_size)
+        print("converting {} videos in {} shards with {} workers".format(len(files), len(shards), workers))
 
-     print("\nencoding "+file+" |",end='')
-     
-     while True:
-          print("=",end='')
-          retval,frame=cap.read()
-          
-          if not retval:
-               break
+        start_time = time.time()
+        total_frames = 0
+        # spawn: TensorFlow is not fork-safe once its runtime has started.
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(workers, initializer=init_worker, initargs=(style, tf_threads, options)) as pool:
+            for file, index, count in pool.imap_unordered(transfer_shard, shards):
+                total_frames += count
+                print("{} shard {} done ({} frames)".format(file, index, count))
 
-          style_image=style_transfer.predict(frame)
-          seg_mask=image_segmentation.predict(frame)   
-          seg_mask = cv2.cvtColor(seg_mask, cv2.COLOR_GRAY2RGB)
+        for file in files:
+            merge_segments(file, [shard[4] for shard in shards if shard[0] == file])
+        elapsed = time.time() - start_time
+        print("{} frames in {:.1f}s: {:.2f} fps".format(total_frames, elapsed, total_frames / max(elapsed, 1e-6)))
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
 
-          result_image = np.where(seg_mask, style_image, frame)
 
-          cv2.imshow("result",result_image)
-          out.write(result_image)
+def main():
+    parser = argparse.ArgumentParser(description="Apply style transfer to the videos in the samples folder.")
+    parser.add_argument("--style", default="Na", choices=styles, help="style to apply")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="convert without a preview using batched inference and decode/encode threads")
+    parser.add_argument("--batch-size", type=int, default=8, help="frames per model call in pipeline mode")
+    parser.add_argument("--queue-depth", type=int, default=32, help="frames buffered between pipeline stages")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="convert all videos with this many worker processes (0: one process)")
+    parser.add_argument("--tf-threads", type=int, default=1, help="TensorFlow threads of each worker process")
+    parser.add_argument("--shard-frames", type=int, default=240, help="frames per shard in worker mode")
+    parser.add_argument("--style-scale", type=float, default=1.0,
+                        help="resolution the style network runs at, relative to the video size")
+    parser.add_argument("--feather", type=int, default=0,
+                        help="blur size in pixels that softens the mask edge (0: hard edge)")
+    parser.add_argument("--tile-size", type=int, default=0,
+                        help="stylize in overlapping tiles of this size to bound memory on large videos (0: off)")
+    parser.add_argument("--tile-overlap", type=int, default=32, help="overlap of neighbouring tiles in pixels")
+    parser.add_argument("--tile-batch", type=int, default=4, help="tiles per model call")
+    parser.add_argument("--style-backend", default="savedmodel", choices=["savedmodel", "hub", "tflite", "onnx"],
+                        help="inference backend of the style model")
+    parser.add_argument("--style-model", help="model file of the style backend (default: the backend's model)")
+    parser.add_argument("--segmentation-backend", default="keras", choices=["keras", "tflite", "onnx"],
+                        help="inference backend of the segmentation model")
+    parser.add_argument("--segmentation-model",
+                        help="model file of the segmentation backend (default: the backend's model)")
+    parser.add_argument("--resources", default=None,
+                        help="thread and CPU configuration saved by 'resources.py autotune' "
+                             "(default: resources.json when it exists, else the default split of the cores)")
+    args = parser.parse_args()
+    options["style_scale"] = args.style_scale
+    options["feather"] = args.feather
+    options["tile_size"] = args.tile_size or None
+    options["tile_overlap"] = args.tile_overlap
+    options["tile_batch"] = args.tile_batch
+    options["style_backend"] = args.style_backend
+    options["style_model"] = args.style_model
+    options["segmentation_backend"] = args.segmentation_backend
+    options["segmentation_model"] = args.segmentation_model
+    if args.workers == 0:
+        # Worker processes get their own budgets (--tf-threads).
+        options["resources"] = ResourceConfig.load_or_default(args.resources or "resources.json")
+        options["resources"].apply(uses_tensorflow(args.style_backend, args.segmentation_backend))
 
-          key=cv2.waitKey(30)
-          if key==32:
-               print("|")
-               break
-          
-          if key==ord('q'):
-               print("|") 
-               loop=False
-               break
-          
-     cap.release()
-     out.release()
-     cv2.destroyAllWindows()
+    files = sorted(os.listdir(os.path.join(path, "samples")))
+    if args.workers > 0:
+        transfer_videos_sharded(files, args.style, args.workers, args.tf_threads, args.shard_frames, args.batch_size)
+        return
 
-     if loop==False:
-          break
+    for file in files:
+        if args.pipeline:
+            transfer_video_pipelined(file, args.style, args.batch_size, args.queue_depth)
+        elif not transfer_video(file, args.style):
+            break
 
 
-     
+if __name__ == '__main__':
+    main()
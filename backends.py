@@ -0,0 +1,257 @@
+"""
+Description: Inference backends of the style transfer and segmentation models
+(TensorFlow SavedModel / Keras, TFLite interpreter and ONNX Runtime)
+
+Every backend works on float32 numpy arrays in [0, 1]:
+- Style backends: encode_style(style (1, h, w, 3)) returns the style in the form the backend uses
+  (the style bottleneck for split models, else the style image itself),
+  and transfer(content (n, h, w, 3), style) returns the stylized images (n, h, w, 3).
+  style is one encoded style for all the images, or n styles stacked, one per image.
+- Segmentation backends: infer(images (n, 256, 256, 3)) returns the predictions (n, 256, 256, 2).
+
+TensorFlow, TFLite and ONNX Runtime are imported only by the backend that uses them.
+"""
+
+import os
+import urllib.request
+
+import numpy as np
+
+MODEL_DIR = './models'
+
+# Default model files of every backend.
+STYLE_MODELS = {
+    'savedmodel': os.path.join(MODEL_DIR, 'magenta_arbitrary-image-stylization-v1-256_2'),
+    'hub': 'https://tfhub.dev/google/magenta/arbitrary-image-stylization-v1-256/2',
+    # Split (style prediction, style transform) models, downloaded the first time they are used.
+    # A fused model made by convert_models.py can be given as the path instead.
+    'tflite': (os.path.join(MODEL_DIR, 'magenta_arbitrary-image-stylization-v1-256_fp16_prediction.tflite'),
+               os.path.join(MODEL_DIR, 'magenta_arbitrary-image-stylization-v1-256_fp16_transfer.tflite')),
+    'onnx': os.path.join(MODEL_DIR, 'magenta_arbitrary-image-stylization-v1-256_fp32.onnx'),
+}
+# Where the default models that are not shipped are downloaded from.
+STYLE_MODEL_URLS = {
+    'tflite': ('https://tfhub.dev/google/lite-model/magenta/arbitrary-image-stylization-v1-256/fp16/prediction/1'
+               '?lite-format=tflite',
+               'https://tfhub.dev/google/lite-model/magenta/arbitrary-image-stylization-v1-256/fp16/transfer/1'
+               '?lite-format=tflite'),
+}
+SEGMENTATION_MODELS = {
+    'keras': os.path.join(MODEL_DIR, 'unet_no_drop.h5'),
+    'tflite': os.path.join(MODEL_DIR, 'unet_no_drop_fp16.tflite'),
+    'onnx': os.path.join(MODEL_DIR, 'unet_no_drop_fp32.onnx'),
+}
+
+
+def create_style_backend(name='savedmodel', path=None, num_threads=None):
+    # Create the style backend selected by name, with the default model of the backend unless path is given.
+    # For 'tflite' and 'onnx', path is one fused model file or a (prediction, transfer) pair of split models.
+    if path is None:
+        path = STYLE_MODELS[name]
+        for file, url in zip(path, STYLE_MODEL_URLS.get(name, ())):
+            fetch_model(file, url)
+    if name == 'savedmodel':
+        return SavedModelStyleBackend(path)
+    if name == 'hub':
+        return SavedModelStyleBackend(path, use_hub=True)
+    if name == 'tflite':
+        return LiteStyleBackend(path, num_threads)
+    if name == 'onnx':
+        return OnnxStyleBackend(path, num_threads)
+    raise ValueError('unknown style backend: {}'.format(name))
+
+
+def fetch_model(path, url):
+    # Download a model file to path the first time it is needed.
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        urllib.request.urlretrieve(url, path + '.part')
+        os.replace(path + '.part', path)
+    return path
+
+
+def create_segmentation_backend(name='keras', path=None, num_threads=None):
+    # Create the segmentation backend selected by name, with the default model of the backend unless path is given.
+    if path is None:
+        path = SEGMENTATION_MODELS[name]
+    if name == 'keras':
+        return KerasSegmentationBackend(path)
+    if name == 'tflite':
+        return LiteSegmentationBackend(path, num_threads)
+    if name == 'onnx':
+        return OnnxSegmentationBackend(path, num_threads)
+    raise ValueError('unknown segmentation backend: {}'.format(name))
+
+
+class SavedModelStyleBackend:
+    # The fused magenta SavedModel (local or from tensorflow_hub).
+    def __init__(self, path, use_hub=False):
+        import tensorflow as tf
+        self.tf = tf
+        if use_hub:
+            import tensorflow_hub as hub
+            self.model = hub.load(path)
+        else:
+            self.model = tf.saved_model.load(path, tags=None)
+        self.signature = self.model.signatures['serving_default']
+
+    def encode_style(self, style):
+        # The fused model predicts the style on every call, so the style image itself is kept.
+        return style
+
+    def transfer(self, content, style):
+        style = self.tf.constant(style)
+        if len(content) > 1 and len(style) == 1:
+            style = self.tf.repeat(style, len(content), axis=0)
+        return self.signature(placeholder=self.tf.constant(content), placeholder_1=style)['output_0'].numpy()
+
+
+class LiteStyleBackend:
+    # TFLite interpreter of the split models (the style bottleneck is computed once per style)
+    # or of a fused model converted with convert_models.py.
+    def __init__(self, path, num_threads=None):
+        import tensorflow as tf
+        if isinstance(path, (tuple, list)):
+            predict_path, transfer_path = path
+            self.predict = tf.lite.Interpreter(model_path=predict_path, num_threads=num_threads)
+            self.predict.allocate_tensors()
+            self.transfer_interpreter = tf.lite.Interpreter(model_path=transfer_path, num_threads=num_threads)
+            self.transfer_interpreter.allocate_tensors()
+            self.runner = None
+        else:
+            self.predict = None
+            interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+            self.runner = interpreter.get_signature_runner('serving_default')
+            self.transfer_interpreter = interpreter
+
+    def encode_style(self, style):
+        if self.predict is None:
+            return style
+        return run_lite(self.predict, [style])[0]
+
+    def transfer(self, content, style):
+        n = len(content)
+        if n > 1 and len(style) == 1:
+            style = np.repeat(style, n, axis=0)
+        if self.runner is not None:
+            # The signature runner resizes its inputs to the given shapes.
+            return self.runner(placeholder=content, placeholder_1=style)['output_0']
+        return run_lite(self.transfer_interpreter, [content, style])[0]
+
+
+class OnnxStyleBackend:
+    # ONNX Runtime session of a fused model, or of split (prediction, transfer) models.
+    def __init__(self, path, num_threads=None):
+        if isinstance(path, (tuple, list)):
+            self.predict = onnx_session(path[0], num_threads)
+            self.session = onnx_session(path[1], num_threads)
+        else:
+            self.predict = None
+            self.session = onnx_session(path, num_threads)
+
+    def encode_style(self, style):
+        if self.predict is None:
+            return style
+        return run_onnx(self.predict, [style])[0]
+
+    def transfer(self, content, style):
+        n = len(content)
+        if n > 1 and len(style) == 1:
+            style = np.repeat(style, n, axis=0)
+        return run_onnx(self.session, [content, style])[0]
+
+
+class KerasSegmentationBackend:
+    # The Keras U-Net, called through a graph function with a fixed input signature.
+    # Keras predict() adds data-adapter and callback work to every call, which dominates at batch size 1.
+    # The function is traced once here so the first frame does not pay for it.
+    # The batch dimension is free for batched calls.
+    def __init__(self, path, input_size=(256, 256)):
+        import tensorflow as tf
+        self.model = tf.keras.models.load_model(path)
+        width, height = input_size
+        self.function = tf.function(lambda images: self.model(images, training=False),
+                                    input_signature=[tf.TensorSpec([None, height, width, 3], tf.float32)])
+        self.function(tf.zeros((1, height, width, 3), dtype=tf.float32))
+
+    def infer(self, images):
+        return self.function(images).numpy()
+
+
+class LiteSegmentationBackend:
+    # TFLite interpreter of the U-Net (see convert_models.py).
+    def __init__(self, path, num_threads=None, input_size=(256, 256)):
+        import tensorflow as tf
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        width, height = input_size
+        self.infer(np.zeros((1, height, width, 3), dtype=np.float32))
+
+    def infer(self, images):
+        return run_lite(self.interpreter, [images])[0]
+
+
+class OnnxSegmentationBackend:
+    # ONNX Runtime session of the U-Net (see convert_models.py).
+    def __init__(self, path, num_threads=None, input_size=(256, 256)):
+        self.session = onnx_session(path, num_threads)
+        width, height = input_size
+        self.infer(np.zeros((1, height, width, 3), dtype=np.float32))
+
+    def infer(self, images):
+        return run_onnx(self.session, [images])[0]
+
+
+def run_lite(interpreter, inputs):
+    # Run a TFLite interpreter.
+    # Inputs are matched to the input tensors by their last dimension so the order of the model does not matter:
+    # a style bottleneck is (1, 1, 1, 100) and images are (1, h, w, 3).
+    details = sorted(interpreter.get_input_details(), key=lambda d: d['shape'][-1] == 3, reverse=True)
+    arrays = sorted(inputs, key=lambda a: a.shape[-1] == 3, reverse=True)
+    resized = False
+    for detail, array in zip(details, arrays):
+        if tuple(detail['shape']) != array.shape:
+            interpreter.resize_tensor_input(detail['index'], array.shape)
+            resized = True
+    if resized:
+        interpreter.allocate_tensors()
+        details = sorted(interpreter.get_input_details(), key=lambda d: d['shape'][-1] == 3, reverse=True)
+    for detail, array in zip(details, arrays):
+        # Quantized models take integer inputs: the float input is mapped with the tensor's scale and zero point.
+        scale, zero_point = detail['quantization']
+        if detail['dtype'] != np.float32 and scale:
+            array = np.round(array / scale + zero_point)
+        interpreter.set_tensor(detail['index'], array.astype(detail['dtype']))
+    interpreter.invoke()
+    outputs = []
+    for detail in interpreter.get_output_details():
+        output = interpreter.get_tensor(detail['index'])
+        scale, zero_point = detail['quantization']
+        if detail['dtype'] != np.float32 and scale:
+            output = (output.astype(np.float32) - zero_point) * scale
+        outputs.append(output)
+    return outputs
+
+
+def onnx_session(path, num_threads=None):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+    return ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+def run_onnx(session, inputs):
+    # Run an ONNX Runtime session. Inputs are matched like run_lite.
+    names = [i.name for i in session.get_inputs()]
+    if len(names) == 2 and all(len(i.shape) == 4 and i.shape[-1] == 3 for i in session.get_inputs()):
+        # Fused style model: content and style are both images, so they are matched by name
+        # (placeholder and placeholder_1, with a ':0' suffix after tf2onnx).
+        content, style = inputs
+        feeds = {name: style if name.split(':')[0].endswith('_1') else content for name in names}
+    else:
+        ordered = sorted(session.get_inputs(), key=lambda i: i.shape[-1] == 3, reverse=True)
+        arrays = sorted(inputs, key=lambda a: a.shape[-1] == 3, reverse=True)
+        feeds = {i.name: a for i, a in zip(ordered, arrays)}
+    return session.run(None, {name: np.asarray(array, dtype=np.float32) for name, array in feeds.items()})
@@ -0,0 +1,165 @@
+"""
+Description: Per-stage benchmark of the video pipeline over the videos of the samples folder
+
+Run the benchmark and save the results:
+    python benchmark.py run --output results/benchmark.json
+Compare a run with a saved baseline (exit code 1 when a stage regressed):
+    python benchmark.py compare baseline.json results/benchmark.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+
+import VideoTransfer
+from compositor import Compositor
+from metrics import StageStats, peak_rss_mb
+
+STAGES = ["decode", "preprocess", "style", "segment", "composite", "encode"]
+
+
+def benchmark_video(file, style, max_frames=None, segmentation_interval=1):
+    # Run one video through the production StyleTransfer, ImageSegmentation and Compositor
+    # and measure every stage of every frame.
+    cap, frame_size = VideoTransfer.open_capture(file)
+    style_transfer, image_segmentation = VideoTransfer.load_models(frame_size, style)
+    image_segmentation.keyframe_interval = segmentation_interval
+    compositor = Compositor(*frame_size, feather=VideoTransfer.options["feather"], buffers=1)
+
+    stats = StageStats()
+    with tempfile.TemporaryDirectory() as directory:
+        out = VideoTransfer.open_writer(os.path.join(directory, "benchmark.avi"), frame_size)
+        frames = 0
+        start_time = time.perf_counter()
+        while max_frames is None or frames < max_frames:
+            with stats.time("decode"):
+                retval, frame = cap.read()
+            if not retval:
+                break
+
+            with stats.time("style"):
+                style_image = style_transfer.predict(frame)
+            if segmentation_interval > 1:
+                # Keyframe mode: the mask comes from the model or from propagation, pre-processing included.
+                with stats.time("segment"):
+                    seg_mask = image_segmentation.predict(frame)
+            else:
+                with stats.time("preprocess"):
+                    input_image = image_segmentation.image_ready(frame)
+                with stats.time("segment"):
+                    seg_mask = image_segmentation.generate_mask(image_segmentation.infer(input_image))
+            with stats.time("composite"):
+                result_image = compositor.composite(frame, style_image, seg_mask, person=True)
+            with stats.time("encode"):
+                out.write(result_image)
+            frames += 1
+        elapsed = time.perf_counter() - start_time
+        out.release()
+    cap.release()
+
+    return {"frames": frames, "seconds": elapsed, "fps": frames / max(elapsed, 1e-9),
+            "frame_size": list(frame_size), "stages": stats.summary()}
+
+
+def run(args):
+    VideoTransfer.options["style_scale"] = args.style_scale
+    VideoTransfer.options["feather"] = args.feather
+    files = sorted(os.listdir(os.path.join(VideoTransfer.path, "samples")))
+    files = [file for file in files if file.endswith(".mp4")]
+
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "opencv": cv2.__version__, "cpu_count": os.cpu_count()},
+        "settings": {"style": args.style, "frames": args.frames, "style_scale": args.style_scale,
+                     "feather": args.feather, "segmentation_interval": args.segmentation_interval},
+        "videos": {},
+    }
+    for file in files:
+        result = benchmark_video(file, args.style, args.frames, args.segmentation_interval)
+        report["videos"][file] = result
+        print_result(file, result)
+    # The peak RSS is the high-water mark of the process, so it is only reported for the whole run.
+    report["peak_rss_mb"] = peak_rss_mb()
+    print("\npeak RSS of the run: {} MB".format(
+        "-" if report["peak_rss_mb"] is None else "{:.0f}".format(report["peak_rss_mb"])))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("saved", args.output)
+
+
+def print_result(file, result):
+    print("\n{}: {} frames, {:.2f} fps".format(file, result["frames"], result["fps"]))
+    print("  {:<11}{:>10}{:>10}{:>10}".format("stage", "p50 ms", "p95 ms", "p99 ms"))
+    for stage in STAGES:
+        if stage in result["stages"]:
+            s = result["stages"][stage]
+            print("  {:<11}{:>10.2f}{:>10.2f}{:>10.2f}".format(stage, s["p50_ms"], s["p95_ms"], s["p99_ms"]))
+
+
+def compare(args):
+    # Flag every latency percentile that grew, and every fps that dropped, by more than the tolerance.
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    regressions = []
+    for file, result in current["videos"].items():
+        base = baseline["videos"].get(file)
+        if base is None:
+            print("{}: not in the baseline".format(file))
+            continue
+        if result["fps"] < base["fps"] * (1 - args.tolerance):
+            regressions.append("{} fps: {:.2f} -> {:.2f}".format(file, base["fps"], result["fps"]))
+        for stage, stats in result["stages"].items():
+            base_stats = base["stages"].get(stage)
+            if base_stats is None:
+                continue
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                if stats[key] > base_stats[key] * (1 + args.tolerance):
+                    regressions.append("{} {} {}: {:.2f} -> {:.2f}".format(
+                        file, stage, key, base_stats[key], stats[key]))
+
+    for regression in regressions:
+        print("REGRESSION", regression)
+    if not regressions:
+        print("no regressions (tolerance {:.0%})".format(args.tolerance))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage benchmark over the videos of the samples folder.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="benchmark the samples and print the results")
+    run_parser.add_argument("--style", default="Na", choices=VideoTransfer.styles)
+    run_parser.add_argument("--frames", type=int, default=None, help="frames per video (default: all)")
+    run_parser.add_argument("--style-scale", type=float, default=1.0)
+    run_parser.add_argument("--feather", type=int, default=0)
+    run_parser.add_argument("--segmentation-interval", type=int, default=1)
+    run_parser.add_argument("--output", help="JSON file for the results")
+
+    compare_parser = commands.add_parser("compare", help="compare results with a saved baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--tolerance", type=float, default=0.1,
+                                help="allowed relative change before a stage is flagged (default 0.1)")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Description: Combines the style transferred image and the original frame with a person mask
+"""
+
+import cv2
+import numpy as np
+
+
+class Compositor:
+    # This class writes the combined image into preallocated output buffers, so frames do not allocate.
+    def __init__(self, width, height, feather=0, buffers=2):
+        """
+        width, height: The size of the frames.
+        feather: Size of the blur (in pixels) that softens the mask edge. 0 uses the hard mask.
+        buffers: Number of output buffers used in turn. A result stays valid until buffers more frames are combined,
+                 so it must be at least the number of results that are in use at the same time.
+                 0 allocates a new buffer for every result, for results that are kept by reference.
+        """
+        self.width, self.height = width, height
+        self.outputs = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(buffers)]
+        self.next_output = 0
+
+        self.feather = 0
+        self.set_feather(feather)
+
+        # Fixed-point blending buffers: alpha in [0, 255] and 16-bit products.
+        self.alpha = np.empty((height, width), dtype=np.uint8)
+        self.inverse_alpha = np.empty((height, width), dtype=np.uint8)
+        self.product = np.empty((height, width, 3), dtype=np.uint16)
+        self.product2 = np.empty((height, width, 3), dtype=np.uint16)
+
+    def set_feather(self, feather):
+        # Change the feather size. The blur kernel of open-cv must be odd.
+        self.feather = feather
+        self.kernel = (feather | 1, feather | 1)
+
+    def composite(self, frame, style_image, mask, person=False, out=None):
+        # Combine style_image and frame.
+        # person: Apply the style to the person (mask == 1) instead of the background.
+        # out: Buffer for the result. By default the next output buffer is used.
+        if out is None and not self.outputs:
+            out = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        elif out is None:
+            out = self.outputs[self.next_output]
+            self.next_output = (self.next_output + 1) % len(self.outputs)
+
+        if person:
+            foreground, background = style_image, frame
+        else:
+            foreground, background = frame, style_image
+
+        if self.feather > 0:
+            return self.blend(foreground, background, mask, out)
+
+        # The single-channel mask is broadcast over the color channels without a copy.
+        np.copyto(out, background)
+        np.copyto(out, foreground, where=mask.view(bool)[:, :, np.newaxis])
+        return out
+
+    def blend(self, foreground, background, mask, out):
+        # Alpha blending with a blurred mask.
+        # out = (foreground * a + background * (255 - a)) / 255 in 16-bit integers,
+        # with the division done as (x + 128 + ((x + 128) >> 8)) >> 8, which is exact for x <= 255 * 255.
+        np.multiply(mask, 255, out=self.alpha)
+        cv2.GaussianBlur(self.alpha, self.kernel, 0, dst=self.alpha)
+        np.subtract(255, self.alpha, out=self.inverse_alpha)
+
+        np.multiply(foreground, self.alpha[:, :, np.newaxis], out=self.product, dtype=np.uint16)
+        np.multiply(background, self.inverse_alpha[:, :, np.newaxis], out=self.product2, dtype=np.uint16)
+        np.add(self.product, self.product2, out=self.product)
+        np.add(self.product, 128, out=self.product)
+        np.right_shift(self.product, 8, out=self.product2)
+        np.add(self.product, self.product2, out=self.product)
+        np.right_shift(self.product, 8, out=self.product)
+        np.copyto(out, self.product, casting='unsafe')
+        return out
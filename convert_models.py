@@ -0,0 +1,228 @@
+"""
+Description: Offline conversion of the models in the models folder to TFLite and ONNX, in fp32, fp16 or int8,
+checked against the outputs of the original models
+
+Convert the style model to an fp16 TFLite model:
+    python convert_models.py style --format tflite --precision fp16
+Convert the segmentation model to an int8 ONNX model:
+    python convert_models.py segmentation --format onnx --precision int8
+
+int8 models are calibrated with frames of the samples folder (and the style images for the style model).
+Every converted model is run next to the original one on sample frames; the exit code is 1 when it is not close enough.
+ONNX conversion needs tf2onnx, onnxruntime and, for fp16, onnxconverter-common.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from backends import MODEL_DIR, STYLE_MODELS, SEGMENTATION_MODELS, create_style_backend, \
+    create_segmentation_backend
+from image_segmentation import SegmentationEngine
+from style_library import style_files
+from style_transfer import STYLE_SIZE, image2float
+
+path = os.path.dirname(os.path.abspath(__file__))
+
+# Largest accepted mean absolute error of the stylized images (values in [0, 1]).
+STYLE_TOLERANCE = {'fp32': 0.002, 'fp16': 0.01, 'int8': 0.05}
+# Smallest accepted intersection over union of the person masks.
+SEGMENTATION_TOLERANCE = {'fp32': 0.99, 'fp16': 0.97, 'int8': 0.9}
+
+# Size of the content images used for calibration and checks.
+CONTENT_SIZE = (384, 288)
+
+
+def output_path(model, fmt, precision):
+    # models/<model name>_<precision>.<format>
+    if model == 'style':
+        name = os.path.basename(STYLE_MODELS['savedmodel'].rstrip('/'))
+        name = name[:-2] if name.endswith('_2') else name
+    else:
+        name = os.path.splitext(os.path.basename(SEGMENTATION_MODELS['keras']))[0]
+    return os.path.join(MODEL_DIR, '{}_{}.{}'.format(name, precision, fmt))
+
+
+def sample_frames(count, size=CONTENT_SIZE):
+    # Frames spread over the videos of the samples folder, resized to size (BGR, uint8).
+    frames = []
+    files = sorted(f for f in os.listdir(os.path.join(path, 'samples')) if f.endswith('.mp4'))
+    per_file = max(1, -(-count // max(1, len(files))))
+    for file in files:
+        cap = cv2.VideoCapture(os.path.join(path, 'samples', file))
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or per_file
+        for i in range(per_file):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, i * total // per_file)
+            retval, frame = cap.read()
+            if retval:
+                frames.append(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+        cap.release()
+    return frames[:count]
+
+
+def style_images():
+    # The style images of the style folder, ready for the style model.
+    images = []
+    for file in style_files(os.path.join(path, 'style')):
+        image = Image.open(os.path.join(path, 'style', file)).convert('RGB').resize(STYLE_SIZE)
+        images.append(image2float(np.array([image])))
+    return images
+
+
+def style_dataset(count):
+    # (content, style) pairs in the input format of the style model.
+    styles = style_images()
+    return [(image2float(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)[np.newaxis]), styles[i % len(styles)])
+            for i, frame in enumerate(sample_frames(count))]
+
+
+def segmentation_dataset(count):
+    # Inputs of the segmentation model, pre-processed like the application does.
+    width, height = CONTENT_SIZE
+    engine = SegmentationEngine(width, height, width, height)
+    return [engine.prepare(frame).copy() for frame in sample_frames(count)]
+
+
+def convert_tflite(model, precision, dataset, output):
+    import tensorflow as tf
+    if model == 'style':
+        converter = tf.lite.TFLiteConverter.from_saved_model(STYLE_MODELS['savedmodel'],
+                                                             signature_keys=['serving_default'])
+    else:
+        converter = tf.lite.TFLiteConverter.from_keras_model(tf.keras.models.load_model(SEGMENTATION_MODELS['keras']))
+
+    if precision == 'fp16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif precision == 'int8':
+        # Weights and activations in int8, calibrated on the dataset. Inputs and outputs stay float32.
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+        def representative_dataset():
+            for sample in dataset:
+                if model == 'style':
+                    content, style = sample
+                    yield {'placeholder': content, 'placeholder_1': style}
+                else:
+                    yield [sample]
+
+        converter.representative_dataset = representative_dataset
+
+    with open(output, 'wb') as f:
+        f.write(converter.convert())
+
+
+def convert_onnx(model, precision, dataset, output):
+    import onnx
+    with tempfile.TemporaryDirectory() as directory:
+        fp32_path = output if precision == 'fp32' else os.path.join(directory, 'fp32.onnx')
+        if model == 'style':
+            subprocess.run([sys.executable, '-m', 'tf2onnx.convert', '--saved-model', STYLE_MODELS['savedmodel'],
+                            '--signature_def', 'serving_default', '--opset', '13', '--output', fp32_path],
+                           check=True)
+        else:
+            import tensorflow as tf
+            import tf2onnx
+            keras_model = tf.keras.models.load_model(SEGMENTATION_MODELS['keras'])
+            tf2onnx.convert.from_keras(keras_model, opset=13, output_path=fp32_path,
+                                       input_signature=[tf.TensorSpec((None, 256, 256, 3), tf.float32, name='input')])
+
+        if precision == 'fp16':
+            from onnxconverter_common import float16
+            onnx.save(float16.convert_float_to_float16(onnx.load(fp32_path), keep_io_types=True), output)
+        elif precision == 'int8':
+            from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+
+            class Reader(CalibrationDataReader):
+                # Calibration feeds, named like the inputs of the fp32 model.
+                def __init__(self):
+                    import onnxruntime as ort
+                    inputs = ort.InferenceSession(fp32_path, providers=['CPUExecutionProvider']).get_inputs()
+                    self.feeds = iter([feeds(inputs, sample) for sample in dataset])
+
+                def get_next(self):
+                    return next(self.feeds, None)
+
+            quantize_static(fp32_path, output, Reader(), weight_type=QuantType.QInt8, activation_type=QuantType.QUInt8)
+
+
+def feeds(inputs, sample):
+    # Input dict of an ONNX model for one sample of the dataset.
+    if len(inputs) == 1:
+        return {inputs[0].name: sample}
+    content, style = sample
+    return {i.name: style if i.name.split(':')[0].endswith('_1') else content for i in inputs}
+
+
+def check_style(fmt, output, precision, dataset):
+    # Mean and max absolute error of the converted style model against the SavedModel.
+    reference = create_style_backend('savedmodel')
+    converted = create_style_backend(fmt, output)
+    errors = []
+    for content, style in dataset:
+        expected = reference.transfer(content, reference.encode_style(style))
+        actual = converted.transfer(content, converted.encode_style(style))
+        errors.append(np.abs(np.clip(actual, 0, 1) - np.clip(expected, 0, 1)))
+    mean_error = float(np.mean([e.mean() for e in errors]))
+    max_error = float(max(e.max() for e in errors))
+    print('mean absolute error {:.5f}, max {:.5f} (tolerance {})'.format(
+        mean_error, max_error, STYLE_TOLERANCE[precision]))
+    return mean_error <= STYLE_TOLERANCE[precision]
+
+
+def check_segmentation(fmt, output, precision, dataset, threshold=0.1):
+    # Intersection over union of the person masks of the converted model and the Keras model.
+    reference = create_segmentation_backend('keras')
+    converted = create_segmentation_backend(fmt, output)
+    intersection = union = 0
+    for sample in dataset:
+        expected = reference.infer(sample)[..., 1] > threshold
+        actual = converted.infer(sample)[..., 1] > threshold
+        intersection += np.count_nonzero(expected & actual)
+        union += np.count_nonzero(expected | actual)
+    iou = intersection / union if union else 1.0
+    print('mask IoU {:.4f} (tolerance {})'.format(iou, SEGMENTATION_TOLERANCE[precision]))
+    return iou >= SEGMENTATION_TOLERANCE[precision]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the models to TFLite or ONNX in fp32, fp16 or int8.")
+    parser.add_argument("model", choices=["style", "segmentation"])
+    parser.add_argument("--format", default="tflite", choices=["tflite", "onnx"])
+    parser.add_argument("--precision", default="fp16", choices=["fp32", "fp16", "int8"])
+    parser.add_argument("--output", help="converted model file (default: models/<model>_<precision>.<format>)")
+    parser.add_argument("--calibration-frames", type=int, default=64, help="sample frames used to calibrate int8")
+    parser.add_argument("--check-frames", type=int, default=16, help="sample frames used to check the result")
+    parser.add_argument("--no-check", action="store_true", help="skip the comparison with the original model")
+    args = parser.parse_args()
+
+    output = args.output or output_path(args.model, args.format, args.precision)
+    make_dataset = style_dataset if args.model == 'style' else segmentation_dataset
+    calibration = make_dataset(args.calibration_frames) if args.precision == 'int8' else None
+
+    if args.format == 'tflite':
+        convert_tflite(args.model, args.precision, calibration, output)
+    else:
+        convert_onnx(args.model, args.precision, calibration, output)
+    print('saved', output, '({:.1f} MB)'.format(os.path.getsize(output) / (1024 * 1024)))
+
+    if args.no_check:
+        return
+    dataset = make_dataset(args.check_frames)
+    if args.model == 'style':
+        ok = check_style(args.format, output, args.precision, dataset)
+    else:
+        ok = check_segmentation(args.format, output, args.precision, dataset)
+    if not ok:
+        print('the converted model is not close enough to the original model')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
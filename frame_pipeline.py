@@ -0,0 +1,66 @@
+"""
+Description: Hand-off between the capture, inference and display stages of the camera,
+and the bus that delivers processed frames to their consumers
+"""
+
+from threading import Condition
+
+
+class Mailbox:
+    # One-slot mailbox with latest-frame semantics.
+    # put() replaces a frame that has not been taken yet (the replaced frame is counted as dropped),
+    # and get() waits for a frame instead of spinning.
+    def __init__(self):
+        self.condition = Condition()
+        self.item = None
+        self.closed = False
+        # Number of frames that were replaced before anyone took them.
+        self.dropped = 0
+        # Number of frames that were taken.
+        self.delivered = 0
+
+    def put(self, item):
+        # Leave the newest frame in the mailbox.
+        with self.condition:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        # Take the newest frame, waiting up to timeout seconds for one.
+        # Returns None on timeout or when the mailbox was closed.
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.item is not None or self.closed, timeout):
+                return None
+            item = self.item
+            self.item = None
+            if item is not None:
+                self.delivered += 1
+            return item
+
+    def close(self):
+        # Wake up every waiting get().
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class FrameBus:
+    # Publishes each processed frame once to several sinks (display, recorder, pictures, metrics).
+    # The frame is made read-only before it is published, so every sink can keep a reference without a copy.
+    # A sink that wants to draw on the frame (the display) must draw on its own copy.
+    def __init__(self):
+        self.sinks = []
+        # Number of published frames.
+        self.published = 0
+
+    def subscribe(self, sink):
+        # sink(frame, timestamp) is called on the publishing thread for every frame, so it must not block.
+        self.sinks.append(sink)
+
+    def publish(self, frame, timestamp):
+        frame.setflags(write=False)
+        self.published += 1
+        for sink in self.sinks:
+            sink(frame, timestamp)
@@ -3,96 +3,224 @@ Programmer: Dahsom Jang
 Description: Face Detection and Segmentation
 """
 
-import tensorflow as tf
 import numpy as np
 import cv2
 
+from backends import create_segmentation_backend
+
+# Longest side of the grayscale frames that optical flow runs on.
+FLOW_SIZE = 160
+
 
 class ImageSegmentation:
     # Class that recognizes faces and provides segmentation
-    def __init__(self, width, height, no_drop=True):
+    def __init__(self, width, height, no_drop=True,
+                 keyframe_interval=1, motion_threshold=2.0, min_confidence=0.6,
+                 backend='keras', model_path=None, num_threads=None):
+        """
+        width, height: The size of the frames and of the masks that are returned.
+        keyframe_interval: The model runs at most every keyframe_interval frames of predict().
+                           Masks of the frames in between are warped from the last keyframe with optical flow.
+                           1 runs the model on every frame.
+        motion_threshold: Mean optical flow (in pixels of the flow image) above which the model runs again.
+        min_confidence: Propagation confidence below which the model runs again. Every propagated frame multiplies
+                        the confidence by the share of pixels that the warp explains.
+        backend: Inference backend, 'keras' (default), 'tflite' or 'onnx' (see backends.py),
+                 or a backend object that is shared with other instances (e.g. one per frame size).
+        model_path: Model file of the backend (see backends.SEGMENTATION_MODELS for the defaults),
+                    e.g. an fp16 or int8 file made by convert_models.py.
+        num_threads: Threads of the TFLite / ONNX Runtime backends (None: the runtime default).
+        """
 
         self.width, self.height = width, height
         self.input_size = (256, 256)
 
+        # Keyframe state for mask propagation.
+        self.keyframe_interval = keyframe_interval
+        self.motion_threshold = motion_threshold
+        self.min_confidence = min_confidence
+        flow_rate = FLOW_SIZE / max(width, height)
+        self.flow_size = (max(1, int(width * flow_rate)), max(1, int(height * flow_rate)))
+        grid_x, grid_y = np.meshgrid(np.arange(self.flow_size[0], dtype=np.float32),
+                                     np.arange(self.flow_size[1], dtype=np.float32))
+        self.flow_grid = np.dstack([grid_x, grid_y])
+        self.key_gray = None
+        self.key_mask = None
+        # Set by reset() from other threads; predict() clears it and drops the keyframe.
+        self.reset_requested = False
+        self.since_keyframe = 0
+        self.confidence = 1.0
+        # Counters of how each mask was made.
+        self.keyframes = 0
+        self.propagated = 0
+
         # Image Segmentation Model Load
-        if no_drop:
-            self.model = tf.keras.models.load_model('./models/unet_no_drop.h5')
-        else:
-            self.model = tf.keras.models.load_model('./models/unet.h5')
+        if model_path is None and backend == 'keras' and not no_drop:
+            model_path = './models/unet.h5'
+        if isinstance(backend, str):
+            backend = create_segmentation_backend(backend, model_path, num_threads)
+        self.backend = backend
+        # infer(images) returns the predictions of the model as a numpy array.
+        self.infer = self.backend.infer
+
+        # Pre-processing and mask generation with buffers for this frame size.
+        self.engine = SegmentationEngine(width, height, width, height, self.input_size)
 
     def predict(self, image):
         # Function to pre-process an image,
         # perform segmentation prediction using a model,
         # and generate and return a mask as a result
+        # The mask may be a buffer that is reused by the next call.
+        if self.keyframe_interval <= 1:
+            return self.predict_keyframe(image)
+
+        if type(image) != np.ndarray:
+            image = self.to_bgr(image)
+        gray = cv2.cvtColor(cv2.resize(image, self.flow_size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        if self.reset_requested:
+            self.reset_requested = False
+            self.key_mask = None
+        if self.key_mask is None or self.since_keyframe + 1 >= self.keyframe_interval:
+            return self.refresh(image, gray)
+
+        # Flow from the current frame back to the previous one, so that the previous mask can be sampled with it.
+        flow = cv2.calcOpticalFlowFarneback(gray, self.key_gray, None, 0.5, 2, 15, 2, 5, 1.1, 0)
+        if np.mean(cv2.magnitude(flow[:, :, 0], flow[:, :, 1])) > self.motion_threshold:
+            return self.refresh(image, gray)
+
+        sample_map = self.flow_grid + flow
+        warped_gray = cv2.remap(self.key_gray, sample_map, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        explained = np.count_nonzero(cv2.absdiff(warped_gray, gray) < 20) / gray.size
+        self.confidence *= explained
+        if self.confidence < self.min_confidence:
+            return self.refresh(image, gray)
+
+        self.key_mask = cv2.remap(self.key_mask, sample_map, None, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        self.key_gray = gray
+        self.since_keyframe += 1
+        self.propagated += 1
+        mask = cv2.resize(self.key_mask, (self.width, self.height), interpolation=cv2.INTER_LINEAR)
+        return (mask > 0.5).astype(np.uint8)
+
+    def refresh(self, image, gray):
+        # Run the model and make the frame the new keyframe for propagation.
+        mask = self.predict_keyframe(image)
+        self.key_mask = cv2.resize(mask, self.flow_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+        self.key_gray = gray
+        self.since_keyframe = 0
+        self.confidence = 1.0
+        self.keyframes += 1
+        return mask
+
+    def reset(self):
+        # Forget the keyframe, so that the next predict() runs the model (e.g. after a zoom change).
+        # Only a flag is set: reset() is called from the UI thread while predict() runs on the streaming thread,
+        # so the keyframe state is changed by predict() alone.
+        self.reset_requested = True
+
+    def predict_keyframe(self, image):
+        # Run the segmentation model on the image.
         input_image = self.image_ready(image)
-        seg_mask = self.model.predict(input_image)
+        seg_mask = self.infer(input_image)
         mask = self.generate_mask(seg_mask)
         return mask
 
+    def predict_batch(self, images):
+        # Same as predict, but runs the model once for a list of images and returns a list of masks.
+        input_images = np.concatenate([self.image_ready(image) for image in images])
+        seg_masks = self.infer(input_images)
+        return [self.generate_mask(seg_mask, out=np.empty((self.height, self.width), dtype=np.uint8))
+                for seg_mask in seg_masks]
+
     def image_ready(self, image):
         # Image pre-processing function
+        # Returns the engine's input buffer, which is overwritten by the next call.
         if type(image) != np.ndarray:
-            pil_image = image.convert('RGB')
-            open_cv_image = np.array(pil_image)
-            open_cv_image = open_cv_image[:, :, ::-1].copy()
-            image = open_cv_image
-        else:
-            image = image
+            image = self.to_bgr(image)
+        return self.engine.prepare(image)
 
-        img = image
-        width, height = self.input_size
+    def to_bgr(self, image):
+        # Convert a PIL image to an open-cv image.
+        pil_image = image.convert('RGB')
+        open_cv_image = np.array(pil_image)
+        open_cv_image = open_cv_image[:, :, ::-1].copy()
+        return open_cv_image
 
-        im = np.zeros((width, height, 3), dtype=np.uint8)
-        if img.shape[0] >= img.shape[1]:
-            scale = img.shape[0] / height
-            new_width = int(img.shape[1] / scale)
+    def generate_mask(self, seg_mask, threshold=0.1, out=None):
+        # Function to generate mask with predicted segmentation information
+        # Returns a single-channel uint8 mask (1: person) of the frame size.
+        return self.engine.mask(seg_mask, threshold, out)
+
+
+class SegmentationEngine:
+    # Pre-processing and mask generation for frames of one size.
+    # The letterbox geometry and all the buffers are prepared once, so frames do not allocate.
+    def __init__(self, frame_width, frame_height, mask_width, mask_height, input_size=(256, 256)):
+        """
+        frame_width, frame_height: The size of the frames given to prepare().
+        mask_width, mask_height: The size of the masks made by mask().
+        input_size: The input size of the model.
+        """
+        self.frame_size = (frame_width, frame_height)
+        self.mask_size = (mask_width, mask_height)
+        width, height = input_size
+
+        # Letterbox geometry: the frame is resized to fit the input and centered with black bars.
+        if frame_height >= frame_width:
+            new_width = int(frame_width / (frame_height / height))
             diff = (width - new_width) // 2
-            img = cv2.resize(img, (new_width, height))
-            im[:, diff:diff + new_width, :] = img
-
+            self.region = (slice(0, height), slice(diff, diff + new_width))
+            self.region_size = (new_width, height)
         else:
-            scale = img.shape[1] / width
-            new_height = int(img.shape[0] / scale)
+            new_height = int(frame_height / (frame_width / width))
             diff = (height - new_height) // 2
-            img = cv2.resize(img, (width, new_height))
-            im[diff:diff + new_height, :, :] = img
-
-        input_image = im.reshape((width, height, 3))
-        input_image = image_sharpening(input_image)
-        input_image = input_image.reshape((1, width, height, 3)).astype(np.float32) / 255.
-
-        return input_image
-
-    def generate_mask(self, seg_mask, threshold=0.1):
-        # Function to generate mask with predicted segmentation information
-        height, width = self.height, self.width
-        prediction = seg_mask
-        mask_ori = (prediction.squeeze()[:, :, 1] > threshold).astype(np.uint8)
-        max_size = max(width, height)
-        result_mask = cv2.resize(mask_ori, dsize=(max_size, max_size))
-        if height >= width:
-            diff = (max_size - width) // 2
-            if diff > 0:
-                result_mask = result_mask[:, diff:-diff]
+            self.region = (slice(diff, diff + new_height), slice(0, width))
+            self.region_size = (width, new_height)
+
+        # The bars stay black because only the region is written.
+        self.letterbox = np.zeros((height, width, 3), dtype=np.uint8)
+        self.letterbox_region = self.letterbox[self.region]
+        # open-cv can only write into contiguous arrays; side bars make the region a strided view.
+        if self.letterbox_region.flags['C_CONTIGUOUS']:
+            self.resized = self.letterbox_region
         else:
-            diff = (max_size - height) // 2
-            if diff > 0:
-                result_mask = result_mask[diff:-diff, :]
-        result_mask = cv2.resize(result_mask, dsize=(width, height))
-        return result_mask
-
-
-def image_sharpening(image):
+            self.resized = np.empty_like(self.letterbox_region)
+        self.sharpened = np.empty_like(self.letterbox)
+        self.input = np.empty((1, height, width, 3), dtype=np.float32)
+
+        self.person = np.empty((height, width), dtype=bool)
+        self.mask_out = np.empty((mask_height, mask_width), dtype=np.uint8)
+
+    def prepare(self, image):
+        # Letterbox, sharpen and normalize a frame into the input buffer.
+        cv2.resize(image, self.region_size, dst=self.resized, interpolation=cv2.INTER_AREA)
+        if self.resized is not self.letterbox_region:
+            np.copyto(self.letterbox_region, self.resized)
+        image_sharpening(self.letterbox, dst=self.sharpened)
+        np.multiply(self.sharpened, np.float32(1 / 255.), out=self.input[0], casting='unsafe')
+        return self.input
+
+    def mask(self, seg_mask, threshold=0.1, out=None):
+        # Threshold the person channel, crop the letterbox region and resize it once to the mask size.
+        # Without out, the result is written to the engine's mask buffer, which is overwritten by the next call.
+        if out is None:
+            out = self.mask_out
+        np.greater(seg_mask.reshape(self.person.shape + (-1,))[:, :, 1], threshold, out=self.person)
+        cv2.resize(self.person[self.region].view(np.uint8), self.mask_size, dst=out)
+        return out
+
+
+# Sharpening kernel used on every input of the segmentation model.
+SHARPENING_KERNEL = np.array([[-1, -1, -1, -1, -1],
+                              [-1, 2, 2, 2, -1],
+                              [-1, 2, 9, 2, -1],
+                              [-1, 2, 2, 2, -1],
+                              [-1, -1, -1, -1, -1]]) / 9.0
+
+
+def image_sharpening(image, dst=None):
     # Sharpening the image
-    sharpening = np.array([[-1, -1, -1, -1, -1],
-                           [-1, 2, 2, 2, -1],
-                           [-1, 2, 9, 2, -1],
-                           [-1, 2, 2, 2, -1],
-                           [-1, -1, -1, -1, -1]]) / 9.0
-
-    dst = cv2.filter2D(image, -1, sharpening)
-    return dst
+    return cv2.filter2D(image, -1, SHARPENING_KERNEL, dst=dst)
 
 
 # if __name__ == '__main__':
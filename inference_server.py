@@ -0,0 +1,374 @@
+"""
+Description: Local inference service that holds one copy of the models for several camera streams
+and batches their frames together
+
+Start the server (the web-cams then connect with Camera(inference=InferenceClient())):
+    MEVIA_AUTHKEY=... python inference_server.py --port 9200 --max-batch 8 --max-delay-ms 10
+
+Clients authenticate with a shared key (--authkey-file, or the MEVIA_AUTHKEY / MEVIA_AUTHKEY_FILE environment variables).
+There is no built-in key: the server does not start without one.
+Messages are a JSON header and the raw bytes of a uint8 frame, so nothing a client sends is unpickled.
+
+Every request is a frame with a style index and the face / background mode.
+The scheduler collects the requests of all the streams into batches: a batch runs when it is full or when its oldest
+request has waited max_delay seconds, and every caller gets its own combined frame back.
+LocalInferenceClient is an in-process stand-in for InferenceClient (no socket), e.g. for tests.
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+import numpy as np
+
+from compositor import Compositor
+from image_segmentation import ImageSegmentation
+from metrics import LiveMetrics, MetricsServer
+from resources import ResourceConfig, model_executor, uses_tensorflow
+from style_transfer import StyleTransfer
+
+DEFAULT_ADDRESS = ('127.0.0.1', 9200)
+AUTHKEY_VARIABLE = 'MEVIA_AUTHKEY'
+AUTHKEY_FILE_VARIABLE = 'MEVIA_AUTHKEY_FILE'
+
+# Sentinel that stops the scheduler.
+STOP = None
+
+
+def load_authkey(authkey=None, path=None):
+    # The shared key of the server and its clients: authkey, else the key file, else the environment variables.
+    # Raises ValueError when there is none, so a server never runs with a guessable key.
+    if authkey is None:
+        path = path or os.environ.get(AUTHKEY_FILE_VARIABLE)
+        if path:
+            with open(path, 'rb') as f:
+                authkey = f.read().strip()
+        else:
+            authkey = os.environ.get(AUTHKEY_VARIABLE, '').encode()
+    if isinstance(authkey, str):
+        authkey = authkey.encode()
+    if not authkey:
+        raise ValueError('no authentication key: pass --authkey-file or set {} or {}'.format(
+            AUTHKEY_VARIABLE, AUTHKEY_FILE_VARIABLE))
+    return authkey
+
+
+def send_message(connection, header, image=None):
+    # A message is a JSON header, followed by the bytes of a uint8 image when the header has its shape.
+    if image is not None:
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        header = dict(header, shape=image.shape)
+    connection.send_bytes(json.dumps(header).encode())
+    if image is not None:
+        connection.send_bytes(image.reshape(-1))
+
+
+def recv_message(connection):
+    # Returns (header, image or None). Raises ValueError on a malformed message.
+    header = json.loads(connection.recv_bytes())
+    if not isinstance(header, dict):
+        raise ValueError('message header is not an object')
+    if 'shape' not in header:
+        return header, None
+    shape = tuple(int(n) for n in header['shape'])
+    data = connection.recv_bytes()
+    if len(shape) != 3 or shape[2] != 3 or len(data) != shape[0] * shape[1] * 3:
+        raise ValueError('image of shape {} does not match its {} bytes'.format(shape, len(data)))
+    return header, np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+
+class Request:
+    # A frame waiting for inference and the future of its result.
+    def __init__(self, frame, style, person):
+        self.frame = frame
+        self.style = style
+        self.person = person
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+
+class InferenceService:
+    # One copy of each model, shared by every stream, with a scheduler that batches requests across streams.
+    def __init__(self, max_batch=8, max_delay=0.01, style_scale=1.0, feather=0,
+                 style_backend='savedmodel', segmentation_backend='keras', resources=None, metrics=None):
+        """
+        max_batch: Largest number of frames per model call.
+        max_delay: Longest time in seconds the oldest request of a batch waits for more requests.
+        style_scale: Inference scale of the style model relative to the frame size.
+        feather: Size of the blur that softens the mask edge (0: hard edge).
+        style_backend, segmentation_backend: Inference backend of each model (see backends.py).
+        resources: ResourceConfig with the threads and CPUs of the models and open-cv (None: the saved or default one).
+        metrics: LiveMetrics that receives the batch sizes and latencies (None: a new one).
+        """
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.style_scale = style_scale
+        self.feather = feather
+        self.style_backend = style_backend
+        self.segmentation_backend = segmentation_backend
+        self.resources = resources if resources is not None else ResourceConfig.load_or_default()
+        self.metrics = metrics if metrics is not None else LiveMetrics()
+
+        self.requests = Queue()
+        self.uses_tensorflow = uses_tensorflow(style_backend, segmentation_backend)
+        style_cpus, segmentation_cpus = self.resources.model_cpus(self.uses_tensorflow)
+        self.style_executor = model_executor(style_cpus, 'style')
+        self.segmentation_executor = model_executor(segmentation_cpus, 'segment')
+        self.style_transfer = None
+        self.segmentation_backend_object = None
+        # Segmentation pre-processing and compositing buffers depend on the frame size: one of each per size.
+        self.segmentations = {}
+        self.compositors = {}
+        self.scheduler = None
+
+    def start(self):
+        # Load the models and start the scheduler.
+        self.resources.apply(self.uses_tensorflow)
+        self.style_transfer = self.style_executor.submit(self.load_style_transfer).result()
+        # The segmentation model is loaded once; the instances for each frame size share it.
+        segmentation = self.segmentation_executor.submit(
+            ImageSegmentation, 640, 480, backend=self.segmentation_backend,
+            num_threads=self.resources.segmentation_threads).result()
+        self.segmentation_backend_object = segmentation.backend
+        self.segmentations[(640, 480)] = segmentation
+        self.metrics.set_gauge('queue_depth', self.requests.qsize)
+        self.scheduler = Thread(target=self.schedule, daemon=True)
+        self.scheduler.start()
+        return self
+
+    def load_style_transfer(self):
+        style_transfer = StyleTransfer(640, 480, scale=self.style_scale, num_threads=self.resources.style_threads)
+        style_transfer.load(backend=self.style_backend)
+        style_transfer.warm_up()
+        style_transfer.library.start_watching()
+        return style_transfer
+
+    def style_names(self):
+        return self.style_transfer.style_names()
+
+    def submit(self, frame, style, person=False):
+        # Queue a frame. Returns a future of the combined frame.
+        # style: Index of the style. person: Apply the style to the person instead of the background.
+        request = Request(frame, style, person)
+        self.requests.put(request)
+        return request.future
+
+    def stop(self):
+        self.requests.put(STOP)
+        if self.scheduler is not None:
+            self.scheduler.join()
+        self.style_transfer.library.stop_watching()
+        self.style_executor.shutdown()
+        self.segmentation_executor.shutdown()
+
+    def schedule(self):
+        # Scheduler thread: wait for a request, gather more until the batch is full or the deadline of the first
+        # one has passed, then run the batch. Frames of different sizes are run as separate batches.
+        while True:
+            request = self.requests.get()
+            if request is STOP:
+                return
+            batch = [request]
+            deadline = request.arrival + self.max_delay
+            stop = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    request = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+                except Empty:
+                    break
+                if request is STOP:
+                    stop = True
+                    break
+                batch.append(request)
+
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.frame.shape, []).append(request)
+            for group in groups.values():
+                self.run(group)
+            if stop:
+                return
+
+    def run(self, batch):
+        # Run both models on a batch of frames of the same size and complete the futures.
+        try:
+            height, width = batch[0].frame.shape[:2]
+            segmentation, compositor = self.for_size(width, height)
+            frames = [request.frame for request in batch]
+            start = time.perf_counter()
+            style_future = self.style_executor.submit(
+                self.style_transfer.predict_batch, frames, [request.style for request in batch])
+            seg_future = self.segmentation_executor.submit(segmentation.predict_batch, frames)
+            style_images = style_future.result()
+            seg_masks = seg_future.result()
+            results = [compositor.composite(request.frame, style_image, seg_mask, person=request.person)
+                       for request, style_image, seg_mask in zip(batch, style_images, seg_masks)]
+            self.metrics.observe('batch', time.perf_counter() - start)
+            self.metrics.inc('batches')
+            self.metrics.inc('frames', len(batch))
+            self.metrics.set_gauge('last_batch_size', len(batch))
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        now = time.perf_counter()
+        for request, result in zip(batch, results):
+            self.metrics.observe('request', now - request.arrival)
+            request.future.set_result(result)
+
+    def for_size(self, width, height):
+        # Segmentation and compositor for frames of the size, created the first time the size is seen.
+        key = (width, height)
+        if key not in self.segmentations:
+            self.segmentations[key] = ImageSegmentation(width, height, backend=self.segmentation_backend_object)
+        if key not in self.compositors:
+            # buffers=0: every result is a new array, because it is handed to a caller.
+            self.compositors[key] = Compositor(width, height, feather=self.feather, buffers=0)
+        return self.segmentations[key], self.compositors[key]
+
+
+class InferenceServer:
+    # Serves an InferenceService to the clients of a local socket. Each connection is handled by its own thread,
+    # which sends the frames of the client to the shared scheduler.
+    def __init__(self, service, address=DEFAULT_ADDRESS, authkey=None):
+        """
+        service: InferenceService (or an object with the same submit and style_names).
+        address: (host, port) of the socket.
+        authkey: Key the clients must know (None: from the environment, see load_authkey).
+        """
+        self.service = service
+        self.listener = Listener(address, authkey=load_authkey(authkey))
+        self.running = False
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                # The listener was closed, or a client failed to authenticate or left during the handshake.
+                # The other clients keep being served.
+                continue
+            Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection):
+        # Requests: {'op': 'process', 'style', 'person'} with the frame, and {'op': 'styles'}.
+        # Replies: the image, {'styles': [...]} or {'error': ...}.
+        with connection:
+            while True:
+                try:
+                    message, frame = recv_message(connection)
+                except (EOFError, OSError):
+                    return
+                except ValueError as e:
+                    # A malformed message leaves the stream out of step, so the connection is closed.
+                    try:
+                        send_message(connection, {'error': repr(e)})
+                    except OSError:
+                        pass
+                    return
+                try:
+                    op = message.get('op')
+                    if op == 'process' and frame is not None:
+                        result = self.service.submit(frame, int(message['style']), bool(message['person'])).result()
+                        send_message(connection, {}, result)
+                    elif op == 'styles':
+                        send_message(connection, {'styles': self.service.style_names()})
+                    else:
+                        send_message(connection, {'error': 'unknown operation: {}'.format(op)})
+                except (EOFError, OSError):
+                    return
+                except Exception as e:
+                    send_message(connection, {'error': repr(e)})
+
+    def close(self):
+        self.running = False
+        self.listener.close()
+
+
+class InferenceClient:
+    # Client of an InferenceServer. One connection per camera, so requests of one stream are handled in order.
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None):
+        # authkey: Key of the server (None: from the environment, see load_authkey).
+        self.connection = Client(address, authkey=load_authkey(authkey))
+        self.lock = Lock()
+
+    def call(self, message, image=None):
+        # Returns (header, image or None) of the reply.
+        with self.lock:
+            send_message(self.connection, message, image)
+            reply, result = recv_message(self.connection)
+        if 'error' in reply:
+            raise RuntimeError(reply['error'])
+        return reply, result
+
+    def process(self, frame, style, person=False):
+        # The frame with the style applied to the background (or to the person).
+        return self.call({'op': 'process', 'style': int(style), 'person': bool(person)}, frame)[1]
+
+    def style_names(self):
+        return self.call({'op': 'styles'})[0]['styles']
+
+    def close(self):
+        self.connection.close()
+
+
+class LocalInferenceClient:
+    # In-process stand-in for InferenceClient: the same calls, handed directly to a service.
+    def __init__(self, service):
+        self.service = service
+
+    def process(self, frame, style, person=False):
+        return self.service.submit(frame, style, person).result()
+
+    def style_names(self):
+        return self.service.style_names()
+
+    def close(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local inference server shared by several cameras.")
+    parser.add_argument("--host", default=DEFAULT_ADDRESS[0])
+    parser.add_argument("--port", type=int, default=DEFAULT_ADDRESS[1])
+    parser.add_argument("--max-batch", type=int, default=8, help="largest number of frames per model call")
+    parser.add_argument("--max-delay-ms", type=float, default=10,
+                        help="longest time a request waits for others to join its batch")
+    parser.add_argument("--style-scale", type=float, default=1.0)
+    parser.add_argument("--feather", type=int, default=0)
+    parser.add_argument("--style-backend", default="savedmodel", choices=["savedmodel", "hub", "tflite", "onnx"])
+    parser.add_argument("--segmentation-backend", default="keras", choices=["keras", "tflite", "onnx"])
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve the metrics to Prometheus on this port")
+    parser.add_argument("--authkey-file", default=None,
+                        help="file with the key that clients must know (default: ${} or ${})".format(
+                            AUTHKEY_VARIABLE, AUTHKEY_FILE_VARIABLE))
+    args = parser.parse_args()
+    try:
+        authkey = load_authkey(path=args.authkey_file)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    metrics = LiveMetrics(prefix='mevia_server')
+    service = InferenceService(args.max_batch, args.max_delay_ms / 1000, args.style_scale, args.feather,
+                               args.style_backend, args.segmentation_backend, metrics=metrics).start()
+    if args.metrics_port:
+        MetricsServer(metrics, args.metrics_port).start()
+    server = InferenceServer(service, (args.host, args.port), authkey)
+    print("serving on {}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+        service.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+Description: Latency measurement of the processing stages, live metrics, HUD and Prometheus endpoint
+"""
+
+import sys
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+import cv2
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+
+class StageStats:
+    # This class keeps the latency samples of named stages (decode, style, segment, ...).
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def time(self, stage):
+        # Measure the time spent in a with block as one sample of the stage.
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[stage].append(time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def summary(self):
+        # Count, mean and p50 / p95 / p99 latency in milliseconds of every stage.
+        result = {}
+        for stage, samples in self.samples.items():
+            values = np.array(samples) * 1000
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            result[stage] = {'count': len(values), 'mean_ms': float(values.mean()),
+                             'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+        return result
+
+
+def peak_rss_mb():
+    # Peak resident memory of the process in MB, or None where it cannot be measured.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+
+class Histogram:
+    # Fixed-bucket latency histogram. observe() is a bisect and three additions, so it can run on every frame.
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # Exponential moving average, shown on the HUD.
+        self.recent = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent = value if self.count == 1 else 0.9 * self.recent + 0.1 * value
+
+
+class LiveMetrics:
+    # Metrics of the live camera: per-stage latency histograms, counters and gauges.
+    # They can be drawn as a HUD and exported in the Prometheus text format.
+    def __init__(self, prefix='mevia'):
+        self.prefix = prefix
+        self.lock = Lock()
+        self.histograms = {}
+        self.counters = defaultdict(int)
+        # Gauge values, or functions that return the value when the metrics are read.
+        self.gauges = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        # Measure the time spent in a with block as one observation of the stage.
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def set_gauge(self, name, value):
+        # value may be a function, which is called when the metrics are read.
+        self.gauges[name] = value
+
+    def gauge_values(self):
+        return {name: value() if callable(value) else value for name, value in list(self.gauges.items())}
+
+    def prometheus(self):
+        # The metrics in the Prometheus text exposition format.
+        lines = []
+        name = '{}_stage_latency_seconds'.format(self.prefix)
+        lines.append('# HELP {} Latency of each processing stage.'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, bound, cumulative))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, histogram.sum))
+                lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, histogram.count))
+            counters = dict(self.counters)
+        for counter, value in sorted(counters.items()):
+            lines.append('# TYPE {}_{}_total counter'.format(self.prefix, counter))
+            lines.append('{}_{}_total {}'.format(self.prefix, counter, value))
+        for gauge, value in sorted(self.gauge_values().items()):
+            lines.append('# TYPE {}_{} gauge'.format(self.prefix, gauge))
+            lines.append('{}_{} {}'.format(self.prefix, gauge, value))
+        return '\n'.join(lines) + '\n'
+
+    def hud_lines(self):
+        # Short text lines for the HUD: gauges, then the recent latency of every stage.
+        lines = []
+        for gauge, value in sorted(self.gauge_values().items()):
+            lines.append('{} {:.1f}'.format(gauge, value) if isinstance(value, float) else '{} {}'.format(gauge, value))
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                lines.append('{} {:.1f} ms'.format(stage, histogram.recent * 1000))
+        return lines
+
+
+def draw_hud(image, lines, x=10, line_height=18):
+    # Draw text lines at the bottom left of the image with a shadow, so they can be read on any background.
+    y = image.shape[0] - 10 - line_height * (len(lines) - 1)
+    for line in lines:
+        cv2.putText(image, line, (x + 1, y + 1), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 0, 0), 2, cv2.LINE_AA)
+        cv2.putText(image, line, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 255, 255), 1, cv2.LINE_AA)
+        y += line_height
+
+
+class MetricsServer:
+    # HTTP endpoint on localhost that serves the metrics at /metrics for Prometheus to scrape.
+    def __init__(self, metrics, port=9108, host='127.0.0.1'):
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] != '/metrics':
+                    handler.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                # Scrapes are not logged.
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
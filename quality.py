@@ -0,0 +1,91 @@
+"""
+Description: Adaptive quality controller that holds a target frame rate by changing the cost of inference at runtime
+"""
+
+import time
+
+# Quality levels, from the best to the cheapest.
+# style_scale: Inference scale of the style model. segmentation_interval: Frames per run of the segmentation model.
+# feather: Mask edge blur (0: hard mask, the cheapest compositing).
+QUALITY_LEVELS = (
+    {'style_scale': 1.0, 'segmentation_interval': 1, 'feather': 7},
+    {'style_scale': 1.0, 'segmentation_interval': 3, 'feather': 7},
+    {'style_scale': 0.75, 'segmentation_interval': 3, 'feather': 5},
+    {'style_scale': 0.75, 'segmentation_interval': 5, 'feather': 0},
+    {'style_scale': 0.5, 'segmentation_interval': 5, 'feather': 0},
+    {'style_scale': 0.5, 'segmentation_interval': 8, 'feather': 0},
+    {'style_scale': 0.35, 'segmentation_interval': 10, 'feather': 0},
+)
+
+
+class QualityController:
+    # Feedback controller: it measures the frame time and moves one quality level at a time.
+    # Hysteresis keeps it from oscillating: it drops a level when the frame rate is clearly below the target,
+    # raises one only when it is clearly above it, and waits after every change until the effect can be measured.
+    def __init__(self, target_fps, levels=QUALITY_LEVELS, level=0, down_ratio=0.9, up_ratio=1.3,
+                 down_delay=1.0, up_delay=4.0, smoothing=0.1):
+        """
+        target_fps: Frame rate to hold.
+        levels: Quality levels from the best to the cheapest, dicts of the settings of each level.
+        level: Index of the first level.
+        down_ratio: A level is dropped when the frame rate is below target_fps * down_ratio.
+        up_ratio: A level is raised when the frame rate is above target_fps * up_ratio.
+        down_delay, up_delay: Seconds after a change before the next drop / raise.
+                              Raising waits longer, because a level that is too expensive costs frames.
+                              A raise that has to be undone doubles the wait before the next one (up to a minute).
+        smoothing: Weight of a new frame time in the moving average.
+        """
+        self.target_fps = target_fps
+        self.levels = levels
+        self.level = level
+        self.down_ratio = down_ratio
+        self.up_ratio = up_ratio
+        self.down_delay = down_delay
+        self.up_delay = up_delay
+        self.smoothing = smoothing
+
+        # Moving average of the frame time in seconds, restarted after every change.
+        self.frame_time = None
+        self.changed_at = time.perf_counter()
+        # Number of level changes.
+        self.changes = 0
+        self.raised = False
+        self.raise_delay = up_delay
+
+    def settings(self):
+        return self.levels[self.level]
+
+    def fps(self):
+        return 1 / self.frame_time if self.frame_time else 0.0
+
+    def update(self, frame_seconds):
+        # Add the time of one frame. Returns the settings of the new level when the level changed, else None.
+        if self.frame_time is None:
+            self.frame_time = frame_seconds
+        else:
+            self.frame_time += self.smoothing * (frame_seconds - self.frame_time)
+
+        elapsed = time.perf_counter() - self.changed_at
+        fps = self.fps()
+        if fps < self.target_fps * self.down_ratio and elapsed >= self.down_delay \
+                and self.level < len(self.levels) - 1:
+            if self.raised:
+                # The last raise could not be sustained: wait longer before trying again.
+                self.raise_delay = min(2 * self.raise_delay, 60.0)
+            return self.change(self.level + 1, raised=False)
+        if fps > self.target_fps * self.up_ratio and elapsed >= self.raise_delay and self.level > 0:
+            return self.change(self.level - 1, raised=True)
+        if self.raised and elapsed >= 2 * self.raise_delay:
+            # The raised level holds.
+            self.raised = False
+            self.raise_delay = self.up_delay
+        return None
+
+    def change(self, level, raised):
+        self.level = level
+        self.raised = raised
+        self.changes += 1
+        self.changed_at = time.perf_counter()
+        # The frames measured so far belong to the previous level.
+        self.frame_time = None
+        return self.levels[level]
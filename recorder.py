@@ -0,0 +1,231 @@
+"""
+Description: Video recorder that encodes the processed frames of the camera on its own thread
+"""
+
+import datetime
+import os
+import time
+from collections import deque
+from queue import Queue, Empty, Full
+from threading import Lock, Thread
+
+import cv2
+import numpy as np
+
+# Sentinel that ends the current recording.
+STOP = None
+
+
+class PreRollBuffer:
+    # Fixed-memory ring buffer of the last frames before recording starts.
+    # Frames are copied into one preallocated uint8 slab, so keeping a frame never allocates.
+    def __init__(self, seconds=3, fps=20, max_bytes=64 * 1024 * 1024):
+        """
+        seconds: How much of the past is kept.
+        fps: Expected frame rate until the rate of the pushed frames is measured. With seconds it sizes the slab.
+        max_bytes: Memory cap of the slab. The slab holds fewer frames if seconds * fps frames do not fit.
+        """
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        # Measured rate of the pushed frames (exponential moving average of their timestamps).
+        self.fps = fps
+        self.last_timestamp = None
+        # The slab is allocated on the first frame, when the frame size is known,
+        # and again only when the measured rate asks for a quarter more or less frames.
+        self.slab = None
+        self.timestamps = None
+        self.head = 0
+        self.count = 0
+
+    def capacity(self, frame):
+        # Number of frames of seconds at the measured rate that fit in max_bytes.
+        return min(max(1, int(self.seconds * self.fps)), max(1, self.max_bytes // frame.nbytes))
+
+    def push(self, frame, timestamp):
+        # Copy a frame into the oldest slot.
+        if self.last_timestamp is not None and timestamp > self.last_timestamp:
+            self.fps = 0.9 * self.fps + 0.1 / (timestamp - self.last_timestamp)
+        self.last_timestamp = timestamp
+        capacity = self.capacity(frame)
+        if self.slab is None or self.slab.shape[1:] != frame.shape:
+            self.slab = np.empty((capacity,) + frame.shape, dtype=np.uint8)
+            self.timestamps = np.zeros(capacity, dtype=np.float64)
+            self.head = 0
+            self.count = 0
+        elif abs(capacity - len(self.slab)) * 4 > len(self.slab):
+            self.resize(capacity)
+        np.copyto(self.slab[self.head], frame)
+        self.timestamps[self.head] = timestamp
+        self.head = (self.head + 1) % len(self.slab)
+        self.count = min(self.count + 1, len(self.slab))
+
+    def resize(self, capacity):
+        # Move the newest kept frames into a slab of the capacity.
+        slots = self.slots()[-capacity:]
+        slab = np.empty((capacity,) + self.slab.shape[1:], dtype=np.uint8)
+        timestamps = np.zeros(capacity, dtype=np.float64)
+        for i, slot in enumerate(slots):
+            slab[i] = self.slab[slot]
+            timestamps[i] = self.timestamps[slot]
+        self.slab = slab
+        self.timestamps = timestamps
+        self.count = len(slots)
+        self.head = self.count % capacity
+
+    def slots(self):
+        # Slab indexes of the kept frames, oldest first.
+        capacity = len(self.slab)
+        start = (self.head - self.count) % capacity
+        return [(start + i) % capacity for i in range(self.count)]
+
+    def frames(self):
+        # (frame, timestamp) of the kept frames of the last seconds, oldest first.
+        # The frames are views of the slab and stay valid until the next push().
+        if self.count == 0:
+            return []
+        slots = self.slots()
+        newest = self.timestamps[slots[-1]]
+        return [(self.slab[i], self.timestamps[i]) for i in slots if newest - self.timestamps[i] <= self.seconds]
+
+    def clear(self):
+        self.count = 0
+        # The time between the last frame before a recording and the first one after it is not a frame interval.
+        self.last_timestamp = None
+
+
+class Recorder:
+    # The streaming loop hands processed frames to write(), and a recording thread encodes them.
+    # Frames are written at the real capture rate and the file is rotated every segment_seconds.
+    def __init__(self, directory='videos', segment_seconds=600, queue_size=64, storage=None, pre_roll=None):
+        """
+        directory: Folder of the video files.
+        segment_seconds: Length of one video file.
+        queue_size: Number of frames that can wait for the encoder. Frames beyond that are dropped.
+        storage: StorageManager of the folder. Every closed file is added to it, which enforces its budgets.
+        pre_roll: PreRollBuffer that keeps frames while not recording.
+                  A recording starts with the frames it holds, so it includes the moments before start().
+        """
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.storage = storage
+        self.queue = Queue(maxsize=queue_size)
+        self.thread = None
+        self.recording = False
+        self.pre_roll = pre_roll
+        # Pre-roll frames that the encoder writes before the queued frames.
+        self.pending = deque()
+        # Guards the switch between filling the pre-roll and queueing frames.
+        self.lock = Lock()
+        # Set from stop() until the encoder has finished, since it may still read pre-roll frames in place.
+        self.stopping = False
+        # Frames that did not fit in the queue.
+        self.dropped = 0
+        # Frame rate of the incoming frames, measured by the caller.
+        self.fps = 20.0
+
+    def start(self, fps=None):
+        # Start recording. fps is the measured rate of the frames that will be written.
+        if self.recording:
+            return
+        if fps:
+            self.fps = fps
+        # Frames that were queued after the last stop belong to no recording.
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        with self.lock:
+            # The pre-roll is not written while recording, so the encoder can read its frames in place.
+            self.recording = True
+            self.pending = deque(self.pre_roll.frames()) if self.pre_roll is not None else deque()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Stop recording and wait for the encoder to write the frames that were queued.
+        with self.lock:
+            if not self.recording:
+                return
+            self.recording = False
+            self.stopping = True
+        self.queue.put(STOP)
+        self.thread.join()
+        with self.lock:
+            if self.pre_roll is not None:
+                self.pre_roll.clear()
+            self.stopping = False
+
+    def write(self, frame, timestamp=None):
+        # Queue a frame for recording without blocking the caller.
+        # The frame is queued by reference, so the caller must not change it afterwards (see FrameBus).
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            if not self.recording:
+                # Frames that arrive while the encoder finishes are neither recorded nor kept.
+                if self.pre_roll is not None and not self.stopping:
+                    self.pre_roll.push(frame, timestamp)
+                return
+        try:
+            self.queue.put_nowait((frame, timestamp))
+        except Full:
+            self.dropped += 1
+
+    def run(self):
+        # Recording thread Function
+        # Segments are rotated in this loop, one writer at a time.
+        item = self.pending.popleft() if self.pending else self.queue.get()
+        while item is not STOP:
+            item = self.record_segment(item)
+        self.pending.clear()
+
+    def record_segment(self, item):
+        # Write frames to one file until the segment is full or the recording stops.
+        # Returns the first frame of the next segment, or STOP.
+        frame, start_time = item
+        height, width = frame.shape[:2]
+        fps = max(1.0, round(self.fps))
+        filename = self.new_filename()
+        codec = cv2.VideoWriter_fourcc('D', 'I', 'V', 'X')
+        out = cv2.VideoWriter(filename, codec, fps, (width, height))
+
+        written = 0
+        previous = frame
+        while item is not STOP:
+            frame, timestamp = item
+            elapsed = timestamp - start_time
+            if elapsed >= self.segment_seconds:
+                break
+            # Frames are stamped by time: a frame is repeated to cover the time until the next one,
+            # so the video plays at the real speed even when the stream is slower than fps.
+            # Each frame goes to its nearest slot, so capture jitter neither drops nor repeats frames of a steady
+            # stream. The previous frame fills the slots before it; a frame whose slot is taken is dropped.
+            slot = round(elapsed * fps)
+            while written < slot:
+                out.write(previous)
+                written += 1
+            if written == slot:
+                out.write(frame)
+                written += 1
+            previous = frame
+            if self.pending:
+                item = self.pending.popleft()
+                continue
+            try:
+                item = self.queue.get(timeout=1)
+            except Empty:
+                item = STOP if not self.recording else (frame, time.time())
+        out.release()
+        if self.storage is not None:
+            self.storage.add(filename)
+        return item
+
+    def new_filename(self):
+        # File name from the current date and hour, numbered within the hour.
+        now = datetime.datetime.now()
+        date = now.strftime('%Y%m%d')
+        t = now.strftime('%H')
+        num = 1
+        filename = os.path.join(self.directory, 'mevia_{}_{}_{}.avi'.format(date, t, num))
+        while os.path.exists(filename):
+            num += 1
+            filename = os.path.join(self.directory, 'mevia_{}_{}_{}.avi'.format(date, t, num))
+        return filename
@@ -0,0 +1,302 @@
+"""
+Description: CPU resource configuration of the two models and of open-cv (thread budgets and CPU affinity),
+and an auto-tune command that finds the best configuration on a sample clip
+
+Auto-tune on a sample video and save the best configuration:
+    python resources.py autotune --clip video001.mp4 --output resources.json
+Show the configuration that is used when none is saved:
+    python resources.py show
+
+Camera(resources=ResourceConfig.load('resources.json')) and VideoTransfer.py --resources resources.json use it.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+DEFAULT_PATH = 'resources.json'
+
+# Backends that run on the TensorFlow runtime (see backends.py).
+TENSORFLOW_BACKENDS = ('savedmodel', 'hub', 'keras')
+
+
+def uses_tensorflow(style_backend, segmentation_backend):
+    # Whether one of the models runs on the TensorFlow runtime.
+    return style_backend in TENSORFLOW_BACKENDS or segmentation_backend in TENSORFLOW_BACKENDS
+
+
+def available_cpus():
+    # CPUs this process may run on.
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ResourceConfig:
+    # Thread budgets and CPU sets of the style model, the segmentation model and open-cv.
+    def __init__(self, style_threads=2, segmentation_threads=2, opencv_threads=1, inter_op_threads=2,
+                 intra_op_threads=None, cpus=None, style_cpus=None, segmentation_cpus=None):
+        """
+        style_threads, segmentation_threads: Threads of each model. TensorFlow has one intra-op pool per process,
+                                             so it gets their sum; TFLite and ONNX Runtime get one budget each.
+        opencv_threads: Threads of open-cv (resize, filters, optical flow, codecs).
+        inter_op_threads: TensorFlow inter-op threads (2 lets the two models run at the same time).
+        intra_op_threads: TensorFlow intra-op threads (None: style_threads + segmentation_threads).
+        cpus: CPUs of the whole process (None: no affinity).
+        style_cpus, segmentation_cpus: CPUs of the thread that runs each model (None: those of the process).
+                                       Pools that a runtime creates from that thread inherit them.
+                                       Only TFLite and ONNX Runtime have a pool per model. TensorFlow has one pool
+                                       per process, so with a TensorFlow backend the process is pinned to both sets.
+        """
+        self.style_threads = style_threads
+        self.segmentation_threads = segmentation_threads
+        self.opencv_threads = opencv_threads
+        self.inter_op_threads = inter_op_threads
+        self.intra_op_threads = intra_op_threads
+        self.cpus = cpus
+        self.style_cpus = style_cpus
+        self.segmentation_cpus = segmentation_cpus
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def load_or_default(cls, path=DEFAULT_PATH):
+        # The saved configuration (e.g. from autotune), or the default one of this machine.
+        if path and os.path.exists(path):
+            return cls.load(path)
+        return cls.default()
+
+    @classmethod
+    def default(cls):
+        # Split the available cores: half for the style model, a quarter for segmentation and the rest for open-cv.
+        count = len(available_cpus())
+        style_threads = max(1, count // 2)
+        segmentation_threads = max(1, count // 4)
+        opencv_threads = max(1, count - style_threads - segmentation_threads)
+        return cls(style_threads, segmentation_threads, opencv_threads)
+
+    def save(self, path=DEFAULT_PATH):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def model_cpus(self, tensorflow):
+        # CPUs of the style and the segmentation thread (see model_executor).
+        # TensorFlow creates its one intra-op pool on the first model load, so pinning the thread that loads a model
+        # would put both models in a pool on that model's CPUs. With a TensorFlow backend the threads are not pinned.
+        if tensorflow:
+            return None, None
+        return self.style_cpus, self.segmentation_cpus
+
+    def process_cpus(self, tensorflow):
+        # CPUs of the whole process: cpus, or with a TensorFlow backend the CPUs of both models.
+        if self.cpus or not tensorflow or not (self.style_cpus and self.segmentation_cpus):
+            return self.cpus
+        return sorted(set(self.style_cpus) | set(self.segmentation_cpus))
+
+    def apply(self, tensorflow=True):
+        # Configure the process. Must run before TensorFlow starts its runtime (before the first model is loaded),
+        # otherwise the TensorFlow thread counts can no longer change and are left as they are.
+        # tensorflow: Whether a model runs on a TensorFlow backend (see uses_tensorflow).
+        #             Without one, TensorFlow is not imported, so TFLite / ONNX-only setups do not need it.
+        cpus = self.process_cpus(tensorflow)
+        if cpus:
+            set_affinity(cpus, process=True)
+        cv2.setNumThreads(self.opencv_threads)
+        if not tensorflow:
+            return
+        try:
+            import tensorflow as tf
+        except ImportError:
+            return
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(
+                self.intra_op_threads or self.style_threads + self.segmentation_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(self.inter_op_threads)
+        except RuntimeError:
+            # The runtime has already started, so the threads can no longer be changed.
+            pass
+
+    def __repr__(self):
+        return 'ResourceConfig({})'.format(', '.join('{}={}'.format(k, v) for k, v in self.to_dict().items()))
+
+
+def set_affinity(cpus, process=False):
+    # Pin the calling thread (or the whole process) to the CPUs. No-op where affinity is not supported.
+    if not cpus or not hasattr(os, 'sched_setaffinity'):
+        return
+    if process:
+        # Linux sets the affinity per thread: every thread that already runs is pinned, new threads inherit it.
+        tasks = os.listdir('/proc/self/task') if os.path.isdir('/proc/self/task') else [0]
+        for task in tasks:
+            try:
+                os.sched_setaffinity(int(task), cpus)
+            except OSError:
+                # The thread has ended.
+                pass
+    else:
+        # On Linux, 0 is the calling thread.
+        os.sched_setaffinity(0, cpus)
+
+
+def model_executor(cpus, name):
+    # Single-thread executor pinned to cpus, so a model always runs on the same thread and CPUs.
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix=name, initializer=set_affinity, initargs=(cpus,))
+
+
+def candidates(max_trials=None, tensorflow=True):
+    # Configurations to try: thread splits of the available cores, without and with disjoint CPU sets.
+    # Disjoint sets only take effect with TFLite / ONNX Runtime (see ResourceConfig.model_cpus), so they are
+    # not tried when a model runs on TensorFlow.
+    cpus = available_cpus()
+    count = len(cpus)
+    sizes = sorted({1, 2, 4, 8, 16, count // 2, count} - {0})
+    configs = []
+    for style_threads in sizes:
+        for segmentation_threads in sizes:
+            for opencv_threads in (1, 2, 4):
+                if style_threads + segmentation_threads + opencv_threads > max(count, 3):
+                    continue
+                configs.append(ResourceConfig(style_threads, segmentation_threads, opencv_threads))
+                if not tensorflow and style_threads + segmentation_threads <= count \
+                        and hasattr(os, 'sched_setaffinity'):
+                    configs.append(ResourceConfig(
+                        style_threads, segmentation_threads, opencv_threads,
+                        style_cpus=cpus[:style_threads],
+                        segmentation_cpus=cpus[style_threads:style_threads + segmentation_threads]))
+    # Larger budgets first, so a cut-off list keeps the most promising ones.
+    configs.sort(key=lambda c: -(c.style_threads + c.segmentation_threads))
+    return configs[:max_trials] if max_trials else configs
+
+
+def measure(config, clip, frames, style='Na', style_backend='savedmodel', segmentation_backend='keras'):
+    # Run the camera's processing on the first frames of a sample clip with the configuration
+    # and return the frame rate and frame latency percentiles.
+    import numpy as np
+
+    import VideoTransfer
+    from compositor import Compositor
+    from image_segmentation import ImageSegmentation
+    from style_transfer import StyleTransfer
+
+    tensorflow = uses_tensorflow(style_backend, segmentation_backend)
+    config.apply(tensorflow)
+    style_cpus, segmentation_cpus = config.model_cpus(tensorflow)
+    style_executor = model_executor(style_cpus, 'style')
+    segmentation_executor = model_executor(segmentation_cpus, 'segment')
+    cap, frame_size = VideoTransfer.open_capture(clip)
+    # The models are loaded on their threads, so the pools of the runtimes are created there.
+    style_transfer = style_executor.submit(
+        lambda: StyleTransfer(*frame_size, num_threads=config.style_threads)).result()
+    style_executor.submit(style_transfer.load, backend=style_backend).result()
+    style_transfer.change_style(style_transfer.library.index(style))
+    image_segmentation = segmentation_executor.submit(
+        lambda: ImageSegmentation(*frame_size, backend=segmentation_backend,
+                                  num_threads=config.segmentation_threads)).result()
+    compositor = Compositor(*frame_size)
+
+    # Warm up on the first frame.
+    retval, frame = cap.read()
+    if retval:
+        style_executor.submit(style_transfer.predict, frame).result()
+    latencies = []
+    start_time = time.perf_counter()
+    while len(latencies) < frames:
+        retval, frame = cap.read()
+        if not retval:
+            break
+        frame_start = time.perf_counter()
+        style_future = style_executor.submit(style_transfer.predict, frame)
+        seg_future = segmentation_executor.submit(image_segmentation.predict, frame)
+        compositor.composite(frame, style_future.result(), seg_future.result())
+        latencies.append(time.perf_counter() - frame_start)
+    elapsed = time.perf_counter() - start_time
+    cap.release()
+    style_executor.shutdown()
+    segmentation_executor.shutdown()
+
+    p50, p95 = np.percentile(np.array(latencies) * 1000, [50, 95]) if latencies else (0.0, 0.0)
+    return {'frames': len(latencies), 'fps': len(latencies) / max(elapsed, 1e-9),
+            'p50_ms': float(p50), 'p95_ms': float(p95)}
+
+
+def autotune(args):
+    # Every configuration is measured in a new process, because TensorFlow fixes its thread pools when it starts.
+    best = None
+    configs = candidates(args.max_trials, uses_tensorflow(args.style_backend, args.segmentation_backend))
+    print('trying {} configurations on {} ({} frames each)'.format(len(configs), args.clip, args.frames))
+    for config in configs:
+        command = [sys.executable, os.path.abspath(__file__), 'measure', '--clip', args.clip,
+                   '--frames', str(args.frames), '--config', json.dumps(config.to_dict()),
+                   '--style-backend', args.style_backend, '--segmentation-backend', args.segmentation_backend]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print('{}: failed'.format(config))
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        print('{}: {:.2f} fps, p95 {:.1f} ms'.format(config, result['fps'], result['p95_ms']))
+        if best is None or result['fps'] > best[1]['fps']:
+            best = (config, result)
+
+    if best is None:
+        print('no configuration could be measured')
+        return 1
+    config, result = best
+    config.save(args.output)
+    print('best: {} ({:.2f} fps), saved to {}'.format(config, result['fps'], args.output))
+    return 0
+
+
+def add_backend_arguments(parser):
+    # The backends decide which settings take effect, so the configurations are measured with the ones in use.
+    parser.add_argument("--style-backend", default="savedmodel", choices=["savedmodel", "hub", "tflite", "onnx"])
+    parser.add_argument("--segmentation-backend", default="keras", choices=["keras", "tflite", "onnx"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU resource configuration of the models and open-cv.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    autotune_parser = commands.add_parser("autotune", help="measure thread and affinity settings on a sample clip")
+    autotune_parser.add_argument("--clip", default="video001.mp4", help="video in the samples folder")
+    autotune_parser.add_argument("--frames", type=int, default=60, help="frames measured per configuration")
+    autotune_parser.add_argument("--max-trials", type=int, default=None, help="limit the configurations tried")
+    autotune_parser.add_argument("--output", default=DEFAULT_PATH)
+    add_backend_arguments(autotune_parser)
+
+    measure_parser = commands.add_parser("measure", help="measure one configuration (used by autotune)")
+    measure_parser.add_argument("--clip", default="video001.mp4")
+    measure_parser.add_argument("--frames", type=int, default=60)
+    measure_parser.add_argument("--config", required=True, help="configuration as JSON")
+    add_backend_arguments(measure_parser)
+
+    show_parser = commands.add_parser("show", help="print the configuration that would be used")
+    show_parser.add_argument("--path", default=DEFAULT_PATH)
+
+    args = parser.parse_args()
+    if args.command == "autotune":
+        sys.exit(autotune(args))
+    elif args.command == "measure":
+        print(json.dumps(measure(ResourceConfig.from_dict(json.loads(args.config)), args.clip, args.frames,
+                                 style_backend=args.style_backend, segmentation_backend=args.segmentation_backend)))
+    else:
+        print(ResourceConfig.load_or_default(args.path))
+
+
+if __name__ == '__main__':
+    main()
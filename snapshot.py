@@ -0,0 +1,66 @@
+"""
+Description: Saves pictures of the processed frames on background threads
+"""
+
+import datetime
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+# open-cv parameter of the compression level of each picture format.
+COMPRESSION_PARAMS = {
+    '.png': cv2.IMWRITE_PNG_COMPRESSION,  # 0 (fast, large) to 9 (slow, small)
+    '.jpg': cv2.IMWRITE_JPEG_QUALITY,  # 0 (small) to 100 (best)
+    '.webp': cv2.IMWRITE_WEBP_QUALITY,  # 1 (small) to 100 (best)
+}
+
+
+class SnapshotWriter:
+    # This class encodes and writes pictures on a small pool of threads, so taking a picture never stalls display.
+    def __init__(self, directory='images', ext='.png', compression=3, workers=2, user_id='00001'):
+        """
+        directory: Folder of the pictures.
+        ext: Picture format ('.png', '.jpg' or '.webp').
+        compression: Compression level of the format (see COMPRESSION_PARAMS).
+        workers: Number of writer threads.
+        """
+        self.directory = directory
+        self.ext = ext
+        self.params = [COMPRESSION_PARAMS[ext], compression] if ext in COMPRESSION_PARAMS else []
+        self.user_id = user_id
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='snapshot')
+        # Pictures taken within the same second get a number.
+        self.last_name = None
+        self.same_name = 0
+
+    def save(self, frame, callback=None):
+        # Hand a frame to the writer pool and return at once.
+        # callback(filename, ok) is called on the writer thread when the picture has been written.
+        # The frame must not be changed until then.
+        filename = self.new_filename()
+        future = self.pool.submit(self.write, frame, filename)
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(filename, f.exception() is None and f.result()))
+        return future
+
+    def write(self, frame, filename):
+        # Writer thread Function
+        return cv2.imwrite(filename, frame, self.params)
+
+    def new_filename(self):
+        now = datetime.datetime.now()
+        date = now.strftime('%Y%m%d')
+        hour = now.strftime('%H%M%S')
+        name = 'mevia_{}_{}_{}'.format(date, hour, self.user_id)
+        if name == self.last_name:
+            self.same_name += 1
+            name = '{}_{}'.format(name, self.same_name + 1)
+        else:
+            self.last_name = name
+            self.same_name = 0
+        return os.path.join(self.directory, name + self.ext)
+
+    def shutdown(self):
+        # Wait for the pictures that are being written.
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,83 @@
+"""
+Description: Rolling storage of the recorded videos and saved pictures
+"""
+
+import os
+import time
+from collections import deque
+from threading import Lock
+
+
+class StorageManager:
+    # This class owns a folder of files (e.g. videos/ or images/).
+    # It keeps an index of the files with their size and time, built by a single scan at startup,
+    # and removes the oldest files when a new file makes the folder go over its byte, count or age budget.
+    def __init__(self, directory, extensions, max_bytes=None, max_files=None, max_age=None):
+        """
+        directory: The folder that is managed.
+        extensions: File extensions that belong to the folder, e.g. ('.avi',). Other files are left alone.
+        max_bytes: Total size budget of the files in bytes.
+        max_files: Number of files that are kept.
+        max_age: Age in seconds after which files are removed.
+        A budget of None is not enforced.
+        """
+        self.directory = directory
+        self.extensions = tuple(extensions)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.max_age = max_age
+
+        self.lock = Lock()
+        # (time, path, size) of every file, oldest first.
+        self.index = deque()
+        self.total_bytes = 0
+        self.scan()
+        self.enforce()
+
+    def scan(self):
+        # Build the index with one scan of the folder.
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(self.extensions):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        entries.sort()
+        with self.lock:
+            self.index = deque(entries)
+            self.total_bytes = sum(entry[2] for entry in entries)
+
+    def add(self, path):
+        # Register a file that was closed and enforce the budgets.
+        stat = os.stat(path)
+        with self.lock:
+            self.index.append((stat.st_mtime, path, stat.st_size))
+            self.total_bytes += stat.st_size
+        self.enforce()
+
+    def enforce(self):
+        # Remove the oldest files until every budget is met.
+        now = time.time()
+        with self.lock:
+            while self.index and self.over_budget(now):
+                _, path, size = self.index.popleft()
+                self.total_bytes -= size
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def over_budget(self, now):
+        if self.max_files is not None and len(self.index) > self.max_files:
+            return True
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            return True
+        if self.max_age is not None and now - self.index[0][0] > self.max_age:
+            return True
+        return False
+
+    def files(self):
+        # Paths of the indexed files, oldest first.
+        with self.lock:
+            return [entry[1] for entry in self.index]
@@ -0,0 +1,201 @@
+"""
+Description: Library of the style images in the style folder, with their encoded styles in a memory-mapped store
+
+Every style image is encoded once. The encoded styles are kept on disk in a .npy array that is memory-mapped,
+with an index that maps the hash of each style file to its row, so a restart only maps the file.
+New or changed files in the style folder are encoded and added while the application runs.
+"""
+
+import hashlib
+import json
+import os
+import re
+from threading import Event, Lock, Thread
+
+import numpy as np
+
+STYLE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# The bundled styles keep the order of the original buttons, so the default style index still selects Kandinsky.
+BUNDLED_STYLES = ('gogh.jpg', 'kandinsky.jpg', 'monet.jpg', 'picasso.jpg', 'Na.jpg', 'mario.jpg')
+
+
+def style_order(filename):
+    # Bundled styles first, in their original order, then the added ones by name.
+    if filename in BUNDLED_STYLES:
+        return 0, BUNDLED_STYLES.index(filename), ''
+    return 1, 0, filename.lower()
+
+
+def style_files(directory):
+    # Style image files of the directory (not the store folder or other entries), in button order.
+    return sorted((f for f in os.listdir(directory)
+                   if f.lower().endswith(STYLE_EXTENSIONS) and not f.startswith('.')
+                   and os.path.isfile(os.path.join(directory, f))), key=style_order)
+
+
+def style_name(filename):
+    # Name shown on the button: the file name without extension, starting with a capital letter.
+    stem = os.path.splitext(filename)[0]
+    return stem[:1].upper() + stem[1:]
+
+
+def list_styles(directory='style'):
+    # Names of the styles in the directory, without encoding them.
+    return [style_name(f) for f in style_files(directory)]
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StyleLibrary:
+    # The styles of a directory and their encoded styles.
+    def __init__(self, directory='style', encoder=None, key='default', store_directory=None):
+        """
+        directory: Folder of the style images.
+        encoder: encoder(path) returns the encoded style of an image file as an array with a batch dimension of 1.
+                 The store keeps the dtype of the array (float32 vectors or uint8 style images).
+        key: Name of the store. Encoded styles depend on the model and the style size, so each has its own store.
+        store_directory: Folder of the stores (default: .embeddings in the style folder).
+        """
+        self.directory = directory
+        self.encoder = encoder
+        self.store_directory = store_directory or os.path.join(directory, '.embeddings')
+        key = re.sub(r'[^A-Za-z0-9_.-]+', '_', key)
+        self.store_path = os.path.join(self.store_directory, key + '.npy')
+        self.index_path = os.path.join(self.store_directory, key + '.json')
+
+        self.lock = Lock()
+        # Memory-mapped array of the encoded styles, one row per style file hash.
+        self.store = None
+        # hash -> row of the store.
+        self.rows = {}
+        # file name -> [size, mtime_ns, hash], so unchanged files are not hashed again.
+        self.files = {}
+        # The current styles: (name, file name, row), in button order (see style_files).
+        self.styles = []
+
+        # Called with the library after the styles changed.
+        self.listeners = []
+        self.stop_event = Event()
+        self.watcher = None
+
+        self.open_store()
+
+    def open_store(self):
+        # Map the store and read its index. A missing or broken store starts empty.
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            self.store = np.load(self.store_path, mmap_mode='r+')
+            self.rows = {h: row for h, row in index['rows'].items() if row < index['count']}
+            self.files = index['files']
+        except (OSError, ValueError, KeyError):
+            self.store = None
+            self.rows = {}
+            self.files = {}
+
+    def __len__(self):
+        return len(self.styles)
+
+    def names(self):
+        return [name for name, _, _ in self.styles]
+
+    def index(self, name):
+        # Index of the style with the name.
+        return self.names().index(name)
+
+    def embedding(self, i):
+        # Encoded style i, a view of the store with a batch dimension of 1.
+        # A style that was just removed falls back to the last one until the caller picks another.
+        styles = self.styles
+        row = styles[min(i, len(styles) - 1)][2]
+        return self.store[row:row + 1]
+
+    def subscribe(self, listener):
+        # listener(library) is called on the thread that refreshed the library after the styles changed.
+        self.listeners.append(listener)
+
+    def refresh(self):
+        # Scan the directory: encode new and changed files and drop removed ones.
+        # Returns True when the styles changed.
+        with self.lock:
+            styles = []
+            added = False
+            for filename in style_files(self.directory):
+                path = os.path.join(self.directory, filename)
+                stat = os.stat(path)
+                known = self.files.get(filename)
+                if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+                    digest = known[2]
+                else:
+                    digest = file_hash(path)
+                    self.files[filename] = [stat.st_size, stat.st_mtime_ns, digest]
+                if digest not in self.rows:
+                    self.append(digest, np.asarray(self.encoder(path))[0])
+                    added = True
+                styles.append((style_name(filename), filename, self.rows[digest]))
+            for filename in set(self.files) - {f for _, f, _ in styles}:
+                del self.files[filename]
+
+            changed = styles != self.styles
+            self.styles = styles
+            if added or changed:
+                self.save_index()
+        if changed:
+            for listener in self.listeners:
+                listener(self)
+        return changed
+
+    def append(self, digest, embedding):
+        # Add a row to the store, doubling its capacity when it is full.
+        count = len(self.rows)
+        if self.store is None or self.store.shape[1:] != embedding.shape or self.store.dtype != embedding.dtype:
+            # First style, or a store of another shape or type: start a new one.
+            self.rows = {}
+            count = 0
+            self.store = self.allocate(16, embedding.shape, embedding.dtype)
+        elif count >= len(self.store):
+            self.store = self.allocate(2 * len(self.store), embedding.shape, embedding.dtype, self.store[:count])
+        self.store[count] = embedding
+        self.rows[digest] = count
+
+    def allocate(self, capacity, shape, dtype, rows=None):
+        # Create a store file of the capacity with the rows next to the current one and move it into place.
+        # Views of the replaced file stay valid, because the old mapping is kept until it is released.
+        os.makedirs(self.store_directory, exist_ok=True)
+        temporary = self.store_path + '.tmp'
+        store = np.lib.format.open_memmap(temporary, mode='w+', dtype=dtype, shape=(capacity,) + shape)
+        if rows is not None:
+            store[:len(rows)] = rows
+            store.flush()
+        os.replace(temporary, self.store_path)
+        return store
+
+    def save_index(self):
+        self.store.flush()
+        temporary = self.index_path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'count': len(self.rows), 'rows': self.rows, 'files': self.files}, f)
+        os.replace(temporary, self.index_path)
+
+    def start_watching(self, interval=2.0):
+        # Refresh the library every interval seconds on a background thread.
+        self.stop_event.clear()
+        self.watcher = Thread(target=self.watch, args=(interval,), daemon=True)
+        self.watcher.start()
+
+    def watch(self, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                self.refresh()
+            except OSError:
+                # A file is still being copied; it is picked up by the next refresh.
+                pass
+
+    def stop_watching(self):
+        self.stop_event.set()
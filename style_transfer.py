@@ -5,70 +5,246 @@ Reference: https://wikidocs.net/79287
 Style transfer Model: https://tfhub.dev/google/lite-model/magenta/arbitrary-image-stylization-v1-256/fp16/transfer/1
 """
 
-import tensorflow as tf
+import os
+
 import cv2
 import numpy as np
 from PIL import Image
 
+from backends import STYLE_MODELS, create_style_backend
+from style_library import StyleLibrary
+
+# The magenta model was trained with 256x256 style images.
+STYLE_SIZE = (256, 256)
+
+# Guided filter used to restore edges when a stylized image is upscaled.
+GUIDE_RADIUS = 4
+GUIDE_EPS = 0.01 * 255 * 255
+
 
 class StyleTransfer:
     # This class takes an image and converts it to a specified style.
-    def __init__(self, width, height):
-        self.model = None
-        # current: This is an index to select a style belonging to style_img.
+    def __init__(self, width, height, style_size=STYLE_SIZE, scale=1.0, num_threads=None, style_dir='style',
+                 tile_size=None, tile_overlap=32, tile_batch=4):
+        """
+        width, height: The size of the frames to be converted.
+        style_size: The size that style images are resized to before they are encoded.
+        scale: Inference scale. Frames are downscaled by this rate before the network runs
+               and the result is upscaled back to the frame size.
+        num_threads: Threads of the TFLite / ONNX Runtime backends (None: the runtime default).
+        style_dir: Folder of the style images.
+        tile_size: Stylize frames in overlapping tiles of this size (int or (width, height)), so the memory of
+                   the network is bounded by the tile size rather than the frame size. None runs whole frames.
+        tile_overlap: Overlap of neighbouring tiles in pixels. Tiles are blended across it without seams.
+        tile_batch: Tiles per model call.
+        """
+        # Inference backend (see backends.py), created by load().
+        self.backend = None
+        # current: This is an index to select a style of the library.
         self.current = 1
 
-        # Style type.
-        self.style_img = [
-            Image.open("style/gogh.jpg"),
-            Image.open("style/kandinsky.jpg"),
-            Image.open("style/monet.jpg"),
-            Image.open("style/picasso.jpg"),
-            Image.open("style/Na.jpg"),
-            Image.open("style/mario.jpg")
-
-        ]
         self.WIDTH = width
         self.HEIGHT = height
+        self.style_size = style_size
+        self.scale = scale
+        self.num_threads = num_threads
+        self.style_dir = style_dir
+        if isinstance(tile_size, int):
+            tile_size = (tile_size, tile_size)
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_batch = tile_batch
 
-    def load(self, use_hub=False):
-        # Load the model by using tensor-flow_hub or using the local model.
-        if use_hub:
-            import tensorflow_hub as hub
-            module_path = 'https://tfhub.dev/google/magenta/arbitrary-image-stylization-v1-256/2'
-            self.model = hub.load(module_path)
-        else:
-            self.model = tf.saved_model.load("./models/magenta_arbitrary-image-stylization-v1-256_2", tags=None)
+        # Encoded styles of the style folder (see style_library.py), opened by load().
+        # With split models a style is the style bottleneck vector. A fused model encodes nothing, so its style is
+        # the resized style image, kept as uint8 (a quarter of the float32 size).
+        self.library = None
+
+    def load(self, use_hub=False, use_lite=False, backend=None, model_path=None):
+        """
+        Load the model with an inference backend.
+        backend: 'savedmodel' (default), 'hub', 'tflite' or 'onnx'. use_hub and use_lite select 'hub' and 'tflite'.
+        model_path: Model file of the backend (see backends.STYLE_MODELS for the defaults),
+                    e.g. an fp16 or int8 file made by convert_models.py.
+        """
+        if backend is None:
+            backend = 'tflite' if use_lite else 'hub' if use_hub else 'savedmodel'
+        self.backend = create_style_backend(backend, model_path, self.num_threads)
+
+        # Encoded styles depend on the model and the style size, so each combination has its own store.
+        model = model_path or STYLE_MODELS[backend]
+        if isinstance(model, (tuple, list)):
+            model = model[0]
+        key = '{}-{}-{}x{}'.format(backend, os.path.basename(model.rstrip('/')), *self.style_size)
+        # Styles that are not in the store yet are encoded here.
+        self.library = StyleLibrary(self.style_dir, encoder=self.encode_style_file, key=key)
+        self.library.refresh()
+
+    def warm_up(self):
+        # Run the model once on a blank frame, so the first real frame does not pay for graph setup.
+        self.predict(np.zeros((self.HEIGHT, self.WIDTH, 3), dtype=np.uint8))
 
     def change_style(self, i):
-        # Change the index of style_img by changing the current variable.
+        # Change the index of the style by changing the current variable.
         self.current = i
 
+    def style_names(self):
+        return self.library.names()
+
     def convert_style_img(self, image):
         # The image's pre-processing function.
         image = image.convert('RGB')
-        image = image.resize((self.WIDTH, self.HEIGHT))
+        image = image.resize(self.style_size)
         image_numpy = np.array(image)
         image = np.array([image_numpy])
         return image
 
+    def get_style(self, i):
+        # Returns the encoded style i from the library, as the float32 input of the backend.
+        style = self.library.embedding(i)
+        if style.dtype == np.uint8:
+            return image2float(style)
+        return style
+
+    def encode_style_file(self, path):
+        with Image.open(path) as image:
+            return self.encode_style(image)
+
+    def encode_style(self, image):
+        # Pre-process a style image and, with split models, run the style prediction network.
+        # When the backend keeps the style image itself, the uint8 image is returned (see get_style).
+        image = self.convert_style_img(image)
+        style = np.asarray(self.backend.encode_style(image2float(image)))
+        if style.shape == image.shape:
+            return image
+        return style
+
     def predict(self, frame):
         # Takes an image, converts it to the currently set style, and returns it.
-        img = self.convert_style_img(self.style_img[self.current])
-        img = image2constant(img)
+        return self.predict_batch([frame])[0]
+
+    def predict_batch(self, frames, styles=None):
+        # Converts a list of frames of the same size with one model call and returns a list of images.
+        # styles: Style index of each frame (default: the current style for all of them).
+        if styles is None:
+            style = self.get_style(self.current)
+        else:
+            style = np.concatenate([self.get_style(i) for i in styles])
+        if self.tile_size is not None:
+            styles = [style] * len(frames) if styles is None else [style[i:i + 1] for i in range(len(frames))]
+            return [upscale(self.predict_tiled(self.downscale(frame), s), frame) for frame, s in zip(frames, styles)]
 
-        content_image = np.array([cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)])
-        content_image = image2constant(content_image)
+        content_image = np.array([cv2.cvtColor(self.downscale(frame), cv2.COLOR_BGR2RGB) for frame in frames])
+        y_predict = self.backend.transfer(image2float(content_image), style)
+        y_predict = (np.clip(y_predict, 0, 1) * 255).astype(np.uint8)
+        return [upscale(cv2.cvtColor(y, cv2.COLOR_RGB2BGR), frame) for y, frame in zip(y_predict, frames)]
 
-        y_predict = self.model.signatures['serving_default'](placeholder=content_image,
-                                                             placeholder_1=img)['output_0'].numpy()
-        image = cv2.cvtColor((y_predict[0] * 255).astype(np.uint8), cv2.COLOR_RGB2BGR)
+    def predict_tiled(self, image, style):
+        # Stylize an image in overlapping tiles, tile_batch tiles per model call.
+        # Each tile is weighted with ramps across its overlaps, so the tiles fade into each other without seams.
+        # The tiles are blended one row of tiles at a time into a strip buffer the height of a tile,
+        # so apart from the result only the strip and tile_batch tiles are in memory.
+        height, width = image.shape[:2]
+        tile_w, tile_h = min(self.tile_size[0], width), min(self.tile_size[1], height)
+        xs = tile_positions(width, tile_w, self.tile_overlap)
+        ys = tile_positions(height, tile_h, self.tile_overlap)
+        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+        result = np.empty((height, width, 3), dtype=np.uint8)
+        strip = np.zeros((tile_h, width, 3), dtype=np.float32)
+        strip_weight = np.zeros((tile_h, width, 1), dtype=np.float32)
+        tiles = [(x, y) for y in ys for x in xs]
+        row_end = {y: i for i, y in enumerate(ys)}
+
+        for start in range(0, len(tiles), self.tile_batch):
+            batch = tiles[start:start + self.tile_batch]
+            content = np.array([rgb[y:y + tile_h, x:x + tile_w] for x, y in batch])
+            outputs = self.backend.transfer(image2float(content), style)
+            for (x, y), output in zip(batch, outputs):
+                if output.shape[:2] != (tile_h, tile_w):
+                    output = cv2.resize(output, (tile_w, tile_h), interpolation=cv2.INTER_LINEAR)
+                weight = tile_weight(x, y, tile_w, tile_h, width, height, self.tile_overlap)
+                strip[:, x:x + tile_w] += np.clip(output, 0, 1) * weight
+                strip_weight[:, x:x + tile_w] += weight
+
+                if x == xs[-1]:
+                    # The row of tiles is complete: the rows above the next row of tiles are final.
+                    i = row_end[y]
+                    done = (ys[i + 1] - y) if i + 1 < len(ys) else tile_h
+                    np.multiply(strip[:done] / strip_weight[:done], 255, out=strip[:done])
+                    np.copyto(result[y:y + done], strip[:done], casting='unsafe')
+                    strip[:tile_h - done] = strip[done:]
+                    strip[tile_h - done:] = 0
+                    strip_weight[:tile_h - done] = strip_weight[done:]
+                    strip_weight[tile_h - done:] = 0
+        return cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
+
+    def downscale(self, frame):
+        # Resize a frame to the inference scale.
+        if self.scale == 1:
+            return frame
+        height, width = frame.shape[:2]
+        size = (max(1, int(width * self.scale)), max(1, int(height * self.scale)))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+def image2float(image):
+    # Convert an image to float32 in [0, 1], the input of every backend.
+    return np.multiply(image, np.float32(1 / 255.), dtype=np.float32)
+
+
+def tile_positions(length, tile, overlap):
+    # Start positions of tiles that cover [0, length) with at least overlap pixels between neighbours.
+    # The last tile ends at the border, so its overlap with the previous one may be larger.
+    if tile >= length:
+        return [0]
+    stride = max(1, tile - overlap)
+    positions = list(range(0, length - tile, stride))
+    positions.append(length - tile)
+    return positions
+
+
+def tile_weight(x, y, tile_w, tile_h, width, height, overlap):
+    # Blending weight of a tile, (tile_h, tile_w, 1): 1 in the middle, ramping down towards the sides that overlap
+    # a neighbouring tile. Sides on the image border keep the full weight.
+    def ramp(start, size, length):
+        weight = np.ones(size, dtype=np.float32)
+        n = min(overlap, size // 2)
+        if n > 0:
+            # (i + 0.5) / n keeps the weight above 0, so every pixel has some weight.
+            edge = (np.arange(n, dtype=np.float32) + 0.5) / n
+            if start > 0:
+                weight[:n] = edge
+            if start + size < length:
+                weight[size - n:] = np.minimum(weight[size - n:], edge[::-1])
+        return weight
+
+    return (ramp(y, tile_h, height)[:, np.newaxis] * ramp(x, tile_w, width)[np.newaxis, :])[:, :, np.newaxis]
+
+
+def upscale(image, guide):
+    # Resize a stylized image back to the size of the frame it came from.
+    # The full-resolution frame guides the filter so that edges stay sharp after upscaling.
+    height, width = guide.shape[:2]
+    if image.shape[:2] == (height, width):
         return image
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+    return guided_filter(guide, image, GUIDE_RADIUS, GUIDE_EPS)
+
 
+def guided_filter(guide, image, radius, eps):
+    # Guided filter (He et al.) with the grayscale of guide, built from box filters so it needs no opencv-contrib.
+    # The output is locally a linear function of the guide, so it takes the edges of the guide.
+    size = (2 * radius + 1, 2 * radius + 1)
+    gray = cv2.cvtColor(guide, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    source = image.astype(np.float32)
+    mean_gray = cv2.boxFilter(gray, -1, size)
+    variance = cv2.boxFilter(gray * gray, -1, size) - mean_gray * mean_gray
+    gray, mean_gray, variance = gray[..., np.newaxis], mean_gray[..., np.newaxis], variance[..., np.newaxis]
+    mean_source = cv2.boxFilter(source, -1, size)
+    covariance = cv2.boxFilter(gray * source, -1, size) - mean_gray * mean_source
+    a = covariance / (variance + eps)
+    b = mean_source - a * mean_gray
+    result = cv2.boxFilter(a, -1, size) * gray + cv2.boxFilter(b, -1, size)
+    return np.clip(result + 0.5, 0, 255).astype(np.uint8)
 
-def image2constant(image):
-    # Convert an image to a tensor-flow constant.
-    image = image / 255
-    image = image.astype(dtype=np.float32)
-    image = tf.constant(image)
-    return image
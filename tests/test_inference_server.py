@@ -0,0 +1,83 @@
+import socket
+from concurrent.futures import Future
+from multiprocessing import AuthenticationError
+from threading import Thread
+
+import numpy as np
+import pytest
+
+from inference_server import InferenceClient, InferenceServer, load_authkey, recv_message
+
+
+class FakeService:
+    # Stands in for InferenceService: it returns the frame plus the style index, without models.
+    def submit(self, frame, style, person=False):
+        future = Future()
+        future.set_result(frame + style + (100 if person else 0))
+        return future
+
+    def style_names(self):
+        return ['Gogh', 'Kandinsky']
+
+
+@pytest.fixture
+def server():
+    server = InferenceServer(FakeService(), ('127.0.0.1', 0), authkey=b'test')
+    server.thread = Thread(target=server.serve_forever, daemon=True)
+    server.thread.start()
+    yield server
+    server.close()
+
+
+def test_client_round_trip(server):
+    client = InferenceClient(server.listener.address, authkey=b'test')
+    frame = np.zeros((4, 6, 3), dtype=np.uint8)
+    assert client.style_names() == ['Gogh', 'Kandinsky']
+    np.testing.assert_array_equal(client.process(frame, 2), frame + 2)
+    np.testing.assert_array_equal(client.process(frame, 1, person=True), frame + 101)
+    client.close()
+
+
+def test_failed_handshakes_do_not_stop_the_server(server):
+    client = InferenceClient(server.listener.address, authkey=b'test')
+
+    # A client with the wrong key.
+    with pytest.raises(AuthenticationError):
+        InferenceClient(server.listener.address, authkey=b'wrong')
+    # A client that leaves during the handshake.
+    socket.create_connection(server.listener.address).close()
+    server.thread.join(0.5)
+    assert server.thread.is_alive()
+
+    # The connected client and new clients are still served.
+    frame = np.ones((2, 2, 3), dtype=np.uint8)
+    np.testing.assert_array_equal(client.process(frame, 1), frame + 1)
+    other = InferenceClient(server.listener.address, authkey=b'test')
+    assert other.style_names() == ['Gogh', 'Kandinsky']
+    other.close()
+    client.close()
+
+
+def test_server_does_not_unpickle_requests(server):
+    client = InferenceClient(server.listener.address, authkey=b'test')
+    # A pickled object is not a message: the server answers with an error and closes the connection.
+    client.connection.send(['not', 'json'])
+    reply, image = recv_message(client.connection)
+    assert 'error' in reply and image is None
+    client.close()
+
+
+def test_authkey_is_required(monkeypatch, tmp_path):
+    monkeypatch.delenv('MEVIA_AUTHKEY', raising=False)
+    monkeypatch.delenv('MEVIA_AUTHKEY_FILE', raising=False)
+    with pytest.raises(ValueError):
+        load_authkey()
+    with pytest.raises(ValueError):
+        InferenceServer(FakeService(), ('127.0.0.1', 0))
+
+    monkeypatch.setenv('MEVIA_AUTHKEY', 'from-env')
+    assert load_authkey() == b'from-env'
+    path = tmp_path / 'key'
+    path.write_bytes(b'from-file\n')
+    monkeypatch.setenv('MEVIA_AUTHKEY_FILE', str(path))
+    assert load_authkey() == b'from-file'
@@ -0,0 +1,90 @@
+import random
+
+import numpy as np
+
+import recorder
+from recorder import STOP, PreRollBuffer, Recorder
+
+
+class FakeWriter:
+    # Stands in for cv2.VideoWriter and keeps the index of every written frame.
+    def __init__(self, *args):
+        self.frames = []
+        writers.append(self)
+
+    def write(self, frame):
+        self.frames.append(int(frame[0, 0, 0]))
+
+    def release(self):
+        pass
+
+
+writers = []
+
+
+def recorder_with_frames(directory, fps, timestamps):
+    # A recording Recorder with the frames queued, and the first frame. Frame i is filled with i.
+    rec = Recorder(directory, queue_size=len(timestamps) + 1)
+    rec.fps = fps
+    rec.recording = True
+    items = [(np.full((2, 2, 3), i, dtype=np.uint8), timestamp) for i, timestamp in enumerate(timestamps)]
+    for item in items[1:]:
+        rec.queue.put(item)
+    rec.queue.put(STOP)
+    return rec, items[0]
+
+
+def test_jittered_steady_stream_is_written_once_per_frame(tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder.cv2, 'VideoWriter', FakeWriter)
+    writers.clear()
+    fps = 20
+
+    # A steady source at fps whose timestamps jitter by up to 40% of a frame period.
+    jitter = random.Random(0)
+    start = 1000.0
+    timestamps = [start] + [start + (i + jitter.uniform(-0.4, 0.4)) / fps for i in range(1, 200)]
+    rec, first = recorder_with_frames(str(tmp_path), fps, timestamps)
+
+    assert rec.record_segment(first) is STOP
+    assert writers[0].frames == list(range(200))
+
+
+def test_gap_holds_the_previous_frame(tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder.cv2, 'VideoWriter', FakeWriter)
+    writers.clear()
+    rec, first = recorder_with_frames(str(tmp_path), 20, [100.0, 100.5, 100.55])
+
+    assert rec.record_segment(first) is STOP
+    # Frame 1 is shown at 0.5 s, not 0.05 s: the slots of the gap repeat frame 0.
+    assert writers[0].frames == [0] * 10 + [1, 2]
+
+
+def test_pre_roll_is_sized_from_the_measured_rate():
+    pre_roll = PreRollBuffer(seconds=2, fps=20)
+    frame = np.zeros((2, 2, 3), dtype=np.uint8)
+    for i in range(100):
+        pre_roll.push(frame, 100.0 + i / 5)
+    # 2 seconds at the measured 5 fps, not at the expected 20 fps.
+    assert 10 <= len(pre_roll.slab) <= 12
+    assert 10 <= len(pre_roll.frames()) <= 11
+
+    capped = PreRollBuffer(seconds=2, fps=20, max_bytes=4 * frame.nbytes)
+    capped.push(frame, 100.0)
+    assert len(capped.slab) == 4
+
+
+def test_recording_starts_with_the_pre_roll(tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder.cv2, 'VideoWriter', FakeWriter)
+    writers.clear()
+    rec = Recorder(str(tmp_path), pre_roll=PreRollBuffer(seconds=1, fps=10))
+    for i in range(5):
+        rec.write(np.full((2, 2, 3), i, dtype=np.uint8), 100.0 + i / 10)
+    rec.start(10)
+    rec.write(np.full((2, 2, 3), 5, dtype=np.uint8), 100.5)
+    rec.stop()
+
+    assert writers[0].frames == list(range(6))
+    assert not rec.stopping and rec.pre_roll.count == 0
+    # After the stop, frames go to the pre-roll again.
+    rec.write(np.full((2, 2, 3), 6, dtype=np.uint8), 101.0)
+    assert rec.pre_roll.count == 1